@@ -4,15 +4,36 @@ import time
 import json
 import re
 import threading
+import asyncio
 import shutil
 import hashlib
-from pathlib import Path
+import zlib
+import gzip
+import argparse
+import io
+import cProfile
+import pstats
+import tracemalloc
+import select
+import struct
+import ctypes
+import ctypes.util
+import socket
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from pathlib import Path, PureWindowsPath
 from datetime import datetime
-from difflib import unified_diff, Differ
+from difflib import unified_diff, Differ, SequenceMatcher
 from PIL import Image, ImageDraw, ImageFont
-import pystray
 import psutil
 
+try:
+    import pystray
+except Exception:
+    # No tray backend (e.g. headless monitors driven by DropLyx_sim.py)
+    pystray = None
+
 try:
     from plyer import notification as plyer_notif
     HAS_PLYER = True
@@ -20,35 +41,190 @@ except:
     HAS_PLYER = False
 
 CONFIG_FILE = Path.home() / ".lyx_sync_config.json"
+PROCESSED_CONFLICTS_FILE = Path.home() / ".droplyx_processed_conflicts.json"
 LOCK_SUFFIX = ".lock"
 BASELINE_SUFFIX = ".baseline"
 POLL_INTERVAL = 1  # Check every 1 second for faster response
+TIMING_LOG = Path.home() / "droplyx_timing.log"
+TITLE_CACHE_SIZE = 256  # Resolved window titles kept in the LRU
+MERGE_CACHE_SIZE = 16  # Memoized merge outcomes (they hold whole documents)
+PROCESSED_CONFLICTS_SIZE = 500  # Handled Dropbox conflicted copies remembered across scans/restarts
+FILE_HASH_CACHE_SIZE = 1024  # Content hashes keyed by (path, size, mtime)
+INCLUDE_CACHE_SIZE = 1024  # Parsed include insets keyed by document
+CHUNK_CACHE_SIZE = 64  # Chunk fingerprints of recent document versions
+CHUNK_MASK = 0xF  # Rolling hash bits that must be zero to end a chunk (~16 lines per chunk)
+CHUNK_MIN_LINES = 4
+CHUNK_MAX_LINES = 64
+SECTION_LAYOUTS = ("Part", "Chapter", "Section", "Subsection", "Subsubsection")
+SCAN_WORKERS = 8  # Threads listing directories in parallel (helps most on SMB/NFS)
+SCAN_RACY_SECONDS = 2  # Don't trust a cached listing for folders modified this recently (coarse mtimes)
+# Windows listings carry each file's stat, so re-stat'ing a cached listing costs more than listing again
+SCAN_CACHE_LISTINGS = sys.platform != "win32"
+PROFILE_DIR = Path.home() / "droplyx_profiles"
+PROFILE_MODES = ("cprofile", "sample", "tracemalloc")
+PROFILE_PASSES = 60  # Monitor passes covered by one profiling session
+PROFILE_TOP_N = 30  # Entries in the text summary
+PROFILE_SAMPLE_INTERVAL = 0.005  # Seconds between stack samples
+TRACE_VERSION = 1  # Format of --record-trace files
+WORD_MERGE_MAX_COST = 250000  # Token diff budget per line (len(a) * len(b)), beyond it the line conflicts
+WORD_TOKEN_RE = re.compile(r"\w+\s*|[^\w\s]\s*|\s+")  # Words/punctuation with trailing whitespace
+SETTLE_SECONDS = 2  # A changed file must keep the same size/mtime this long before we trust it
+DROPBOX_CACHE_DIR = ".dropbox.cache"  # Dropbox stages partial downloads here
+PRESENCE_DIR = ".droplyx-presence"  # Per-user presence manifests inside each watch folder
+# "<user>@<device>.json"; Dropbox's "(... conflicted copy ...)" duplicates of a manifest never match
+PRESENCE_MANIFEST_RE = re.compile(r"[\w.-]+@[\w.-]+\.json\Z")
+LYXSERVER_TIMEOUT = 2  # Seconds to wait for a reply on the lyxserver pipe
+LYXSERVER_CLIENT = "droplyx"
 
 state = {
     "watch_dirs": [],
-    "locked_files": {},
-    "my_locks": set(),
-    "file_baselines": {},  # {filepath: baseline_path}
-    "file_hashes": {},  # {filepath: last_known_hash}
-    "file_mtimes": {},  # {filepath: last_modification_time} for save detection
-    "pending_merges": {},  # {filepath: remote_backup_path}
-    "processed_conflicts": set(),  # Track processed Dropbox conflict files
+    "documents": {},  # {filepath: TrackedDocument} for locked, baselined or pending documents
+    "status_version": 0,  # Bumped whenever a lock is taken or released
+    "status_cache": None,  # (status_version, my_locks, others) computed for that version
+    "tray_version": None,  # status_version the tray icon was last drawn for
+    "settling": {},  # {filepath: ((size, mtime_ns), first_seen)} for changes still being written
+    "settle_seconds": SETTLE_SECONDS,
+    "lyxpipe": "",  # lyxserver pipe base path, "" = autodetect from LyX preferences
+    "exclude": [],  # gitignore-style patterns pruned from every scan of the watch folders
+    "include": [],  # Patterns re-included after an exclude (like "!pattern")
+    "scan_rules": None,  # IgnoreRules compiled from exclude/include
+    "scan_skipped": (0, 0),  # (folders, files) ignored by the last scan
+    "presence_manifest": False,  # Announce our locks in a presence manifest instead of .lock files
+    "presence": {},  # {watch folder: relative paths we hold} listed in our presence manifest
+    "device_id": None,  # Names this machine's presence manifests (stored in the config)
     "merge_on_save": False,  # Toggle for merge-on-save feature
     "running": True,
     "icon": None,
-    "menu_needs_update": False,
+    "loop": None,  # asyncio event loop running the core tasks
+    "wakeup": None,  # asyncio.Event waking the monitor task early
+    "menu_event": None,  # asyncio.Event requesting a menu rebuild
+    "closing": set(),  # Files whose unlock/merge is running in the background
+    "profiler": None,  # Active ProfileSession, None when not profiling
+    "trace": None,  # TraceRecorder or TraceReplayer observing the monitor passes
+    "graph_children": {},  # {child filepath: master filepath} for included documents not open themselves
+    "save_watcher": None,  # SaveWatcher delivering save events for locked files
     "window_cache": [],  # Cache of windows to avoid slow getAllWindows()
     "window_cache_time": 0,  # Last time windows were cached
     "window_cache_ttl": 5,  # Cache windows for 5 seconds
 }
 
+# The monitor loop, save watcher, conflict threads and tray callbacks all touch `state`.
+# state_lock guards the shared containers (always iterate over snapshots taken under it);
+# per-document locks serialise lock/baseline/merge work on one file, so different
+# documents can be merged and scanned concurrently.
+state_lock = threading.RLock()
+doc_locks = {}  # {filepath: threading.RLock}
+
+# Blocking work is offloaded from the asyncio core: one worker for the monitor scans
+# (so passes never overlap) and a small pool for merges, dialogs and notifications.
+scan_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="droplyx-scan")
+background_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="droplyx-bg")
+
+
+def document_lock(filepath):
+    """Return the lock that serialises lock, baseline and merge work on one document"""
+    with state_lock:
+        lock = doc_locks.get(filepath)
+        if lock is None:
+            lock = doc_locks[filepath] = threading.RLock()
+        return lock
+
+
+class TrackedDocument:
+    """Everything tracked about one document, instead of one dict per field keyed by path"""
+
+    __slots__ = ("path", "locked_by", "mine", "baseline", "hash", "mtime", "signature", "pending_merge",
+                 "chunks")
+
+    def __init__(self, path):
+        self.path = path
+        self.locked_by = None  # User named in the .lock file, None if unlocked
+        self.mine = False  # We hold the lock
+        self.baseline = None  # Baseline copy made when we started editing
+        self.hash = None  # Last known content hash
+        self.mtime = None  # Last modification time, for save detection
+        self.signature = None  # (size, mtime_ns) of the last settled version
+        self.pending_merge = None  # Snapshot of remote changes waiting to be merged
+        self.chunks = None  # Chunk fingerprints of the baseline
+
+    def is_idle(self):
+        return not (self.locked_by or self.mine or self.baseline or self.pending_merge)
+
+
+def get_document(filepath):
+    """Return the record for `filepath`, creating it if needed (call with state_lock held)"""
+    doc = state["documents"].get(filepath)
+    if doc is None:
+        filepath = sys.intern(filepath)
+        doc = state["documents"][filepath] = TrackedDocument(filepath)
+    return doc
+
+
+def forget_if_idle(doc):
+    """Drop a record nothing refers to anymore (call with state_lock held)"""
+    if doc.is_idle():
+        state["documents"].pop(doc.path, None)
+
+
+def lock_status_changed():
+    """Invalidate the cached lock status (call with state_lock held)"""
+    state["status_version"] += 1
+
+
+def take_pending_merge(filepath):
+    """Return and clear the remote snapshot waiting to be merged into `filepath`"""
+    with state_lock:
+        doc = state["documents"].get(filepath)
+        if doc is None:
+            return None
+        pending, doc.pending_merge = doc.pending_merge, None
+        return pending
+
+
+def get_watch_dirs():
+    """Snapshot of the watched folders"""
+    with state_lock:
+        return list(state["watch_dirs"])
+
+
+def get_my_locks():
+    """Snapshot of the files we currently hold locks on"""
+    return get_lock_status()[0]
+
+
+def get_lock_status():
+    """
+    Return (my_locks, others), others being {filepath: user} locked by someone else.
+    Only recomputed when a lock changes; the returned snapshots are shared, don't modify them.
+    """
+    with state_lock:
+        cached = state["status_cache"]
+        if cached is None or cached[0] != state["status_version"]:
+            docs = state["documents"].values()
+            mine = tuple(d.path for d in docs if d.mine)
+            others = {d.path: d.locked_by for d in docs if d.locked_by and not d.mine}
+            cached = state["status_cache"] = (state["status_version"], mine, others)
+    return cached[1], cached[2]
+
+
+def show_notification(title, message):
+    try:
+        plyer_notif.notify(title=title, message=message, timeout=4)
+    except:
+        pass
+
 
 def notify(title, message):
+    trace = state["trace"]
+    if trace is not None and trace.replaying:
+        trace.notifications.append((trace.now, title, message))
+        return
     if HAS_PLYER:
-        try:
-            plyer_notif.notify(title=title, message=message, timeout=4)
-        except:
-            pass
+        if state["loop"] is not None:
+            # Desktop notifications can block for a while - don't stall the caller
+            background_pool.submit(show_notification, title, message)
+        else:
+            show_notification(title, message)
 
 
 def get_resource_path(relative_path):
@@ -123,8 +299,14 @@ def create_icon(color="lightblue"):
 
 def save_config():
     config = {
-        "watch_dirs": state["watch_dirs"],
-        "merge_on_save": state.get("merge_on_save", False)
+        "watch_dirs": get_watch_dirs(),
+        "merge_on_save": state.get("merge_on_save", False),
+        "settle_seconds": state.get("settle_seconds", SETTLE_SECONDS),
+        "lyxpipe": state.get("lyxpipe", ""),
+        "exclude": state.get("exclude", []),
+        "include": state.get("include", []),
+        "presence_manifest": state.get("presence_manifest", False),
+        "device_id": state.get("device_id"),
     }
     CONFIG_FILE.write_text(json.dumps(config, indent=2))
 
@@ -139,7 +321,15 @@ def load_config():
             watch_dirs = data.get("watch_dirs", [])
 
         merge_on_save = data.get("merge_on_save", False)
+        state["settle_seconds"] = data.get("settle_seconds", SETTLE_SECONDS)
+        state["lyxpipe"] = data.get("lyxpipe", "")
+        state["exclude"] = data.get("exclude", [])
+        state["include"] = data.get("include", [])
+        state["scan_rules"] = IgnoreRules(state["exclude"], state["include"])
+        state["presence_manifest"] = data.get("presence_manifest", False)
+        state["device_id"] = data.get("device_id") or new_device_id()
         return watch_dirs, merge_on_save
+    state["device_id"] = new_device_id()
     return [], False
 
 
@@ -147,6 +337,393 @@ def get_username():
     return os.getenv("USER") or os.getenv("USERNAME") or "unknown"
 
 
+def new_device_id():
+    """A name for this machine, unique even if two machines share a host name"""
+    return f"{socket.gethostname()}-{uuid.uuid4().hex[:6]}"
+
+
+def get_device_id():
+    return state.get("device_id") or socket.gethostname()
+
+
+class LRUCache:
+    """Small thread-safe least-recently-used mapping with a fixed capacity"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                return default
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.data
+
+    def __len__(self):
+        with self.lock:
+            return len(self.data)
+
+    def items(self):
+        """(key, value) pairs from least to most recently used"""
+        with self.lock:
+            return list(self.data.items())
+
+
+def glob_to_regex(pattern):
+    """Translate a gitignore glob (*, ?, [...], **) into a regular expression"""
+    out = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            out.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            out.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and pattern.find("]", i + 2) > i:
+            end = pattern.find("]", i + 2)
+            body = pattern[i + 1:end].replace("\\", "\\\\")
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            out.append(f"[{body}]")
+            i = end + 1
+        else:
+            out.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(out)
+
+
+class IgnoreRules:
+    """
+    gitignore-style patterns for the watch folders, compiled once per config.
+    `exclude` patterns hide matching folders and documents from every scan,
+    `include` patterns (or "!pattern") bring back something excluded before.
+    As in .gitignore the last matching pattern wins, "dir/" only matches
+    folders and patterns containing a "/" are relative to the watch folder.
+    """
+
+    def __init__(self, exclude=(), include=()):
+        self.rules = []  # [(regex, include, dir_only)]
+        for pattern in exclude:
+            self.add(pattern, False)
+        for pattern in include:
+            self.add(pattern, True)
+
+    def add(self, pattern, include):
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith("#"):
+            return
+        if pattern.startswith("!"):
+            include = True  # "!pattern" re-includes, whichever list it is in
+            pattern = pattern[1:]
+        dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        if not pattern:
+            return
+        regex = glob_to_regex(pattern.lstrip("/"))
+        if "/" not in pattern:
+            regex = "(?:.*/)?" + regex  # Unanchored: matches at any depth
+        flags = re.IGNORECASE if sys.platform == "win32" else 0
+        self.rules.append((re.compile(regex + r"\Z", flags), include, dir_only))
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def ignored(self, relpath, is_dir):
+        """Whether `relpath` ("/"-separated, relative to its watch folder) is excluded"""
+        ignored = False
+        for regex, include, dir_only in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relpath):
+                ignored = not include
+        return ignored
+
+
+class TreeScan:
+    """Result of one walk over the watch roots"""
+
+    def __init__(self):
+        self.lyx_files = []  # [(root, path, (size, mtime_ns))]
+        self.lock_files = []  # [(path, mtime_ns)]
+        self.dirs = 0
+        self.cached_dirs = 0
+        self.skipped_dirs = 0  # Pruned by the ignore rules, not descended into
+        self.skipped_files = 0
+
+    def to_json(self):
+        return {"lyx": [[root, path, size, mtime_ns] for root, path, (size, mtime_ns) in self.lyx_files],
+                "locks": self.lock_files,
+                "counts": [self.dirs, self.cached_dirs, self.skipped_dirs, self.skipped_files]}
+
+    @classmethod
+    def from_json(cls, data):
+        scan = cls()
+        scan.lyx_files = [(root, path, (size, mtime_ns)) for root, path, size, mtime_ns in data["lyx"]]
+        scan.lock_files = [tuple(lock) for lock in data["locks"]]
+        scan.dirs, scan.cached_dirs, scan.skipped_dirs, scan.skipped_files = data["counts"]
+        return scan
+
+
+def relative_path(root, path):
+    """`path` relative to the watch folder `root`, "/"-separated as in ignore patterns"""
+    return path[len(root):].lstrip("\\/").replace(os.sep, "/")
+
+
+class TreeScanner:
+    """
+    Walk the watch roots with os.scandir in one traversal, listing each level's
+    folders in parallel on a thread pool and reusing the DirEntry stat results.
+    On POSIX, a folder whose mtime hasn't changed since the last walk has the same entries,
+    so its cached listing is reused (only the .lyx/.lock files in it are stat'ed)
+    and its subfolders are still visited. On Windows every folder is listed again:
+    the listing already includes the stats, one round trip instead of one per file.
+    """
+
+    def __init__(self, workers=SCAN_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="droplyx-walk")
+        self.dir_cache = {}  # {folder: (mtime_ns, listed_at, file paths, subfolders)}
+        self.lock = threading.Lock()
+
+    def list_dir(self, folder):
+        """Return (files, subfolders, from_cache) for one folder; files are (path, size, mtime_ns)"""
+        if not SCAN_CACHE_LISTINGS:
+            files, subfolders = self.read_dir(folder) or ([], [])
+            return files, subfolders, False
+        try:
+            mtime_ns = os.stat(folder).st_mtime_ns
+        except OSError:
+            return [], [], False
+        with self.lock:
+            cached = self.dir_cache.get(folder)
+        if cached and cached[0] == mtime_ns and cached[1] - mtime_ns / 1e9 > SCAN_RACY_SECONDS:
+            # Same entries, but files can be rewritten in place without touching the folder
+            files = []
+            for path in cached[2]:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((path, st.st_size, st.st_mtime_ns))
+            return files, cached[3], True
+
+        listed_at = time.time()
+        listing = self.read_dir(folder)
+        if listing is None:
+            return [], [], False
+        files, subfolders = listing
+        with self.lock:
+            self.dir_cache[folder] = (mtime_ns, listed_at, [f[0] for f in files], subfolders)
+        return files, subfolders, False
+
+    def read_dir(self, folder):
+        """List one folder: ([(path, size, mtime_ns)] of .lyx/.lock files, subfolders), or None"""
+        files, subfolders = [], []
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in (DROPBOX_CACHE_DIR, PRESENCE_DIR):
+                                subfolders.append(entry.path)
+                        elif entry.name.endswith((".lyx", LOCK_SUFFIX)):
+                            st = entry.stat()
+                            files.append((entry.path, st.st_size, st.st_mtime_ns))
+                    except OSError:
+                        continue
+        except OSError:
+            return None
+        return files, subfolders
+
+    def scan(self, roots, rules=None):
+        """Walk all roots and collect .lyx and .lock files, pruning what `rules` (IgnoreRules) exclude"""
+        if rules is None:
+            rules = state["scan_rules"]
+        result = TreeScan()
+        level = [(root, root) for root in roots]
+        seen = set()
+        while level:
+            listings = self.pool.map(lambda item: self.list_dir(item[1]), level)
+            next_level = []
+            for (root, folder), (files, subfolders, from_cache) in zip(level, listings):
+                seen.add(folder)
+                result.dirs += 1
+                result.cached_dirs += from_cache
+                for path, size, mtime_ns in files:
+                    is_lock = path.endswith(LOCK_SUFFIX)
+                    # A lock file follows the rules of its document
+                    document = path[: -len(LOCK_SUFFIX)] if is_lock else path
+                    if rules and rules.ignored(relative_path(root, document), False):
+                        result.skipped_files += 1
+                    elif is_lock:
+                        result.lock_files.append((path, mtime_ns))
+                    else:
+                        result.lyx_files.append((root, path, (size, mtime_ns)))
+                for sub in subfolders:
+                    if rules and rules.ignored(relative_path(root, sub), True):
+                        result.skipped_dirs += 1  # Pruned: never listed
+                    else:
+                        next_level.append((root, sub))
+            level = next_level
+
+        # Forget folders that are gone
+        with self.lock:
+            for folder in [f for f in self.dir_cache if f not in seen]:
+                del self.dir_cache[folder]
+        return result
+
+
+class LyxFileIndex:
+    """
+    Basename -> paths index of the .lyx files under the watch roots.
+    Refreshed from the monitor's regular tree walk, so resolving a window title
+    never has to walk or probe the file system itself.
+    """
+
+    def __init__(self):
+        self.roots = None
+        self.by_name = {}  # {lowercase basename: [(root, path), ...]}
+        self.lock = threading.Lock()
+
+    def rebuild(self, roots, entries):
+        """Replace the index with `entries`, an iterable of (root, path) pairs"""
+        by_name = {}
+        for root, path in entries:
+            by_name.setdefault(os.path.basename(path).lower(), []).append((root, path))
+        for paths in by_name.values():
+            paths.sort()
+        with self.lock:
+            changed = by_name != self.by_name
+            self.roots = tuple(roots)
+            self.by_name = by_name
+        if changed:
+            # Resolutions may point to moved/deleted files now
+            title_cache.clear()
+        return changed
+
+    def ensure(self, roots):
+        """Build the index by walking the roots if it doesn't cover them yet"""
+        with self.lock:
+            if self.roots == tuple(roots):
+                return
+        scan = tree_scanner.scan(roots)
+        self.rebuild(roots, [(root, path) for root, path, _ in scan.lyx_files])
+
+    def lookup(self, filename):
+        with self.lock:
+            return list(self.by_name.get(filename.lower(), ()))
+
+
+tree_scanner = TreeScanner()
+lyx_index = LyxFileIndex()
+lock_owner_cache = LRUCache(FILE_HASH_CACHE_SIZE)  # {(lock path, mtime_ns): user}
+title_cache = LRUCache(TITLE_CACHE_SIZE)  # {(title, watch_dirs): resolved paths}
+merge_cache = LRUCache(MERGE_CACHE_SIZE)  # {(baseline, local, remote) hashes: (merged_lines, conflicts)}
+processed_conflicts = LRUCache(PROCESSED_CONFLICTS_SIZE)  # {(conflict path, content hash): time handled}
+file_hash_cache = LRUCache(FILE_HASH_CACHE_SIZE)  # {(path, (size, mtime_ns)): sha256}
+include_cache = LRUCache(INCLUDE_CACHE_SIZE)  # {path: ((size, mtime_ns), included .lyx paths)}
+chunk_cache = LRUCache(CHUNK_CACHE_SIZE)  # {content hash: chunk fingerprints}
+presence_cache = LRUCache(FILE_HASH_CACHE_SIZE)  # {(manifest path, mtime_ns): (user, relative paths)}
+presence_lock = threading.Lock()  # Serialises rewrites of our own presence manifests
+processed_conflicts_lock = threading.Lock()  # Serialises writes of PROCESSED_CONFLICTS_FILE
+
+
+def parse_lyx_window_title(title):
+    """
+    Split a LyX window title into (filename, folder).
+    LyX windows have titles like "filename.lyx - LyX" or "newfile1.lyx (~\\CMCC Dropbox\\...) - LyX";
+    folder is None if the title has no path. Returns None for other windows.
+    """
+    if not title or "LyX" not in title or ".lyx" not in title:
+        return None
+    # Extract the filename from the title
+    parts = title.split(" - LyX")[0]
+
+    # Check if there's a path in parentheses
+    if "(" in parts and ")" in parts:
+        filename = parts.split("(")[0].strip()
+        folder = parts[parts.find("(") + 1:parts.find(")")]
+    else:
+        filename = parts.strip()
+        folder = None
+    if not filename.endswith(".lyx"):
+        return None
+    return filename, folder
+
+
+def resolve_window_title(title, watch_dirs):
+    """
+    Resolve a LyX window title to the .lyx file(s) it shows, using lyx_index.
+    Results (including misses) are kept in an LRU until the index changes.
+    """
+    key = (title, tuple(watch_dirs))
+    resolved = title_cache.get(key)
+    if resolved is not None:
+        return list(resolved)
+
+    resolved = []
+    parsed = parse_lyx_window_title(title)
+    if parsed:
+        filename, folder = parsed
+        candidates = lyx_index.lookup(filename)
+        if folder is None:
+            # No folder in the title - take the first match in each watched folder
+            roots_seen = set()
+            for root, path in candidates:
+                if root not in roots_seen:
+                    roots_seen.add(root)
+                    resolved.append(str(Path(path).resolve()))
+        elif folder.startswith("~\\"):
+            # Windows path relative to some base, e.g. "~\Dropbox\Paper"
+            relative_parts = [part.lower() for part in PureWindowsPath(folder[2:]).parts]
+            n = len(relative_parts)
+            for _, path in candidates:
+                parents = [part.lower() for part in Path(path).parent.parts]
+                if parents[-n:] == relative_parts:
+                    resolved.append(str(Path(path).resolve()))
+                    break
+            else:
+                # Not under a watched folder - probe the usual bases
+                possible_bases = [Path.home(), Path.home().parent, Path("C:\\")]
+                possible_bases.extend(Path(d).parent for d in watch_dirs)
+                for base in possible_bases:
+                    test_path = base.joinpath(*PureWindowsPath(folder[2:]).parts, filename)
+                    if test_path.exists():
+                        resolved.append(str(test_path.resolve()))
+                        break
+        else:
+            filepath = Path(folder) / filename
+            target = str(filepath).lower()
+            if any(path.lower() == target for _, path in candidates) or filepath.exists():
+                resolved.append(str(filepath.resolve()))
+
+    title_cache.put(key, tuple(resolved))
+    return resolved
+
+
 def get_lyx_open_files():
     open_files = []
 
@@ -208,53 +785,10 @@ def get_lyx_open_files():
                     state["window_cache"] = windows
                     state["window_cache_time"] = current_time
 
+                watch_dirs = get_watch_dirs()
+                lyx_index.ensure(watch_dirs)
                 for window in windows:
-                    title = window.title
-                    # LyX windows have titles like "filename.lyx - LyX" or "newfile1.lyx (~\CMCC Dropbox\...) - LyX"
-                    if title and "LyX" in title and ".lyx" in title:
-                        # Extract the filename from the title
-                        parts = title.split(" - LyX")[0]
-
-                        # Check if there's a path in parentheses
-                        if "(" in parts and ")" in parts:
-                            filename = parts.split("(")[0].strip()
-                            folder_path = parts[parts.find("(")+1:parts.find(")")]
-
-                            # Handle Windows path starting with ~\
-                            if folder_path.startswith("~\\"):
-                                relative_folder = folder_path[2:]
-                                relative_path = relative_folder + "\\" + filename
-
-                                possible_bases = [
-                                    Path.home(),
-                                    Path.home().parent,
-                                    Path("C:\\"),
-                                ]
-
-                                for watch_dir in state.get("watch_dirs", []):
-                                    possible_bases.append(Path(watch_dir).parent)
-
-                                filepath = None
-                                for base in possible_bases:
-                                    test_path = base / relative_path
-                                    if test_path.exists() and test_path.suffix == ".lyx":
-                                        filepath = test_path
-                                        break
-
-                                if filepath:
-                                    open_files.append(str(filepath.resolve()))
-                            else:
-                                filepath = Path(folder_path) / filename
-                                if filepath.exists() and filepath.suffix == ".lyx":
-                                    open_files.append(str(filepath.resolve()))
-                        else:
-                            filename = parts.strip()
-                            if filename.endswith(".lyx"):
-                                for watch_dir in state.get("watch_dirs", []):
-                                    for lyx_file in Path(watch_dir).rglob(filename):
-                                        if lyx_file.is_file():
-                                            open_files.append(str(lyx_file.resolve()))
-                                            break
+                    open_files.extend(resolve_window_title(window.title, watch_dirs))
             except Exception as e:
                 pass
     else:
@@ -280,13 +814,218 @@ def compute_file_hash(filepath):
         return None
 
 
+def get_cached_file_hash(filepath, signature):
+    """SHA256 of a file, only re-read when its (size, mtime_ns) signature changes"""
+    key = (str(filepath), signature)
+    file_hash = file_hash_cache.get(key)
+    if file_hash is None:
+        file_hash = observe("file_hash", str(filepath), compute_file_hash, filepath)
+        if file_hash is not None:
+            file_hash_cache.put(key, file_hash)
+    return file_hash
+
+
+def hash_lines(lines):
+    return hashlib.sha256("".join(lines).encode("utf-8", errors="surrogateescape")).hexdigest()
+
+
+def chunk_fingerprints(lines):
+    """
+    Split `lines` into content-defined chunks: a gear-style rolling hash over the CRC-32
+    of each line ends a chunk wherever its low bits are zero, so boundaries follow the
+    text and an edit only changes the chunks around it. Digests are BLAKE2b of the chunk
+    bytes, so the same text gives the same fingerprints in every process.
+    Returns [(first_line, line_count, digest)].
+    """
+    encoded = [line.encode("utf-8", "surrogateescape") for line in lines]
+    chunks = []
+    start = 0
+    rolling = 0
+    for i, data in enumerate(encoded):
+        rolling = ((rolling << 1) + zlib.crc32(data)) & 0xFFFFFFFFFFFFFFFF
+        size = i + 1 - start
+        if (size >= CHUNK_MIN_LINES and not rolling & CHUNK_MASK) or size >= CHUNK_MAX_LINES:
+            chunks.append((start, size, hashlib.blake2b(b"".join(encoded[start:i + 1]), digest_size=8).hexdigest()))
+            start = i + 1
+    if start < len(lines):
+        chunks.append((start, len(lines) - start, hashlib.blake2b(b"".join(encoded[start:]), digest_size=8).hexdigest()))
+    return chunks
+
+
+def get_chunks(lines, content_hash=None):
+    """Chunk fingerprints of `lines`, computed once per content"""
+    key = content_hash or hash_lines(lines)
+    chunks = chunk_cache.get(key)
+    if chunks is None:
+        chunks = chunk_fingerprints(lines)
+        chunk_cache.put(key, chunks)
+    return chunks
+
+
+def common_chunks(versions):
+    """
+    Count the lines all `versions` ([(lines, chunks)]) share at the start and at the end,
+    in whole chunks. Fingerprints find the candidates, the lines themselves confirm them.
+    Returns (prefix_lines, suffix_lines).
+    """
+    first_lines = versions[0][0]
+    prefix = 0
+    for group in zip(*(chunks for _, chunks in versions)):
+        start, size = group[0][0], group[0][1]
+        if any(c[1:] != group[0][1:] for c in group[1:]):
+            break
+        if any(lines[start:start + size] != first_lines[start:start + size] for lines, _ in versions[1:]):
+            break
+        prefix = start + size
+
+    suffix = 0
+    shortest = min(len(lines) for lines, _ in versions)
+    for group in zip(*(reversed(chunks) for _, chunks in versions)):
+        size = group[0][1]
+        if any(c[1:] != group[0][1:] for c in group[1:]) or prefix + suffix + size > shortest:
+            break
+        tails = [lines[len(lines) - suffix - size:len(lines) - suffix] for lines, _ in versions]
+        if any(tail != tails[0] for tail in tails[1:]):
+            break
+        suffix += size
+    return prefix, suffix
+
+
+def section_heading(lines, index):
+    """Title of the LyX section (chapter, subsection, ...) containing line `index`, or None"""
+    for i in range(min(index, len(lines) - 1), -1, -1):
+        if lines[i].startswith("\\begin_layout ") and lines[i].split()[1].rstrip("*") in SECTION_LAYOUTS:
+            words = []
+            for line in lines[i + 1:]:
+                if line.startswith("\\end_layout"):
+                    break
+                if line.strip() and not line.startswith("\\"):
+                    words.append(line.strip())
+            return " ".join(words)[:60] or None
+    return None
+
+
+def changed_section(baseline_chunks, lines, baseline_lines=None):
+    """
+    Title of the section where `lines` first differ from the version `baseline_chunks` describe.
+    The fingerprints skip the unchanged chunks; with `baseline_lines` the first changed line
+    inside the first changed chunk is found too, so an edit just after a heading is named right.
+    """
+    first_change = 0
+    for old, new in zip(baseline_chunks, get_chunks(lines)):
+        if old[1:] != new[1:]:
+            break
+        first_change = new[0] + new[1]
+    if baseline_lines is not None:
+        end = min(len(lines), len(baseline_lines))
+        while first_change < end and lines[first_change] == baseline_lines[first_change]:
+            first_change += 1
+    return section_heading(lines, first_change)
+
+
+def load_processed_conflicts():
+    """Restore the handled-conflicts LRU so a restart doesn't merge the same copies again"""
+    try:
+        entries = json.loads(PROCESSED_CONFLICTS_FILE.read_text())
+    except (OSError, ValueError):
+        return
+    if not isinstance(entries, list):
+        return
+    for entry in entries:
+        try:
+            path, content_hash, handled = entry
+            processed_conflicts.put((path, content_hash), handled)
+        except (ValueError, TypeError):
+            continue  # Skip malformed entries
+
+
+def save_processed_conflicts():
+    if replaying():
+        return
+    entries = [[path, content_hash, handled] for (path, content_hash), handled in processed_conflicts.items()]
+    with processed_conflicts_lock:
+        try:
+            PROCESSED_CONFLICTS_FILE.write_text(json.dumps(entries))
+        except OSError:
+            pass
+
+
+def get_file_signature(filepath):
+    """Return (size, mtime_ns) of a file, or None if it can't be stat'ed"""
+    try:
+        st = os.stat(filepath)
+        return (st.st_size, st.st_mtime_ns)
+    except OSError:
+        return None
+
+
+def is_sync_temp_file(filepath):
+    """
+    Check if a file is a transient artefact written while a sync is in progress,
+    e.g. Dropbox/Office temp files, partial downloads or LyX autosaves.
+    """
+    name = Path(filepath).name
+    return (name.startswith((".~", "~$", ".dropbox"))
+            or name.endswith((".tmp", ".part", ".partial", "~"))
+            or (name.startswith("#") and name.endswith("#")))
+
+
+def has_sync_temp_sibling(filepath):
+    """Check if a temp artefact for this file exists next to it (i.e. a write is still in progress)"""
+    path = Path(filepath)
+    candidates = [
+        path.with_name(f".~{path.name}"),
+        path.with_name(f"~${path.name}"),
+        path.with_name(f"{path.name}.tmp"),
+        path.with_name(f"{path.name}.part"),
+        path.with_name(f"{path.name}.partial"),
+    ]
+    return any(c.exists() for c in candidates)
+
+
+def has_settled(filepath, signature, now):
+    """
+    Debounce a changed file until it is no longer being written.
+    Returns True once `signature` (size, mtime_ns) has been observed unchanged for
+    the settle window and no sync temp artefacts are left next to the file.
+    """
+    window = state.get("settle_seconds", SETTLE_SECONDS)
+    with state_lock:
+        pending = state["settling"].get(filepath)
+        if pending is None or pending[0] != signature:
+            # First time we see this version - start the settle window
+            state["settling"][filepath] = (signature, now)
+            if window > 0:
+                return False
+        elif now - pending[1] < window:
+            return False
+
+    if observe("temp_sibling", filepath, has_sync_temp_sibling, filepath):
+        return False
+
+    with state_lock:
+        state["settling"].pop(filepath, None)
+    return True
+
+
 def create_baseline(filepath):
     """Create baseline copy when starting to edit"""
     baseline_path = Path(f"{filepath}{BASELINE_SUFFIX}")
     try:
-        shutil.copy2(filepath, baseline_path)
-        state["file_baselines"][filepath] = str(baseline_path)
-        state["file_hashes"][filepath] = compute_file_hash(filepath)
+        if not replaying():
+            shutil.copy2(filepath, baseline_path)
+        file_hash = observe("file_hash", filepath, compute_file_hash, filepath)
+        signature = observe("signature", filepath, get_file_signature, filepath)
+        chunks = None
+        if not replaying():
+            with open(baseline_path, 'r', encoding='utf-8', errors='replace') as f:
+                chunks = get_chunks(f.readlines())
+        with state_lock:
+            doc = get_document(filepath)
+            doc.baseline = str(baseline_path)
+            doc.hash = file_hash
+            doc.signature = signature
+            doc.chunks = chunks
         return True
     except Exception as e:
         return False
@@ -295,13 +1034,17 @@ def create_baseline(filepath):
 def remove_baseline(filepath):
     """Remove baseline when done editing"""
     baseline_path = Path(f"{filepath}{BASELINE_SUFFIX}")
-    if baseline_path.exists():
+    if not replaying() and baseline_path.exists():
         try:
             baseline_path.unlink()
         except:
             pass
-    state["file_baselines"].pop(filepath, None)
-    state["file_hashes"].pop(filepath, None)
+    with state_lock:
+        doc = state["documents"].get(filepath)
+        if doc is not None:
+            doc.baseline = doc.hash = doc.signature = doc.chunks = None
+            forget_if_idle(doc)
+        state["settling"].pop(filepath, None)
 
 
 def is_dropbox_conflict_file(filepath):
@@ -358,111 +1101,200 @@ def handle_dropbox_conflict(conflict_filepath):
     Handle a Dropbox conflict file by performing a three-way merge.
     Returns True if successfully merged and removed conflict file.
     """
-    original_filepath = get_original_file_from_conflict(conflict_filepath)
+    original_filepath = observe("conflict_original", conflict_filepath,
+                                get_original_file_from_conflict, conflict_filepath)
     if not original_filepath:
         return False
 
-    # Check if we have a baseline for this file
-    baseline_path = Path(f"{original_filepath}{BASELINE_SUFFIX}")
-    if not baseline_path.exists():
-        # No baseline, can't do three-way merge
-        # Just notify the user
-        notify("Dropbox Conflict Detected",
-               f"{Path(conflict_filepath).name}\n"
-               f"Please manually resolve the conflict.")
-        return False
+    with document_lock(original_filepath):
+        # Check if we have a baseline for this file
+        baseline_path = Path(f"{original_filepath}{BASELINE_SUFFIX}")
+        if not observe("conflict_baseline", original_filepath, baseline_path.exists):
+            # No baseline, can't do three-way merge
+            # Just notify the user
+            notify("Dropbox Conflict Detected",
+                   f"{Path(conflict_filepath).name}\n"
+                   f"Please manually resolve the conflict.")
+            return False
+        if replaying():
+            notify("Dropbox Conflict Detected", f"{Path(conflict_filepath).name}\n(replay: not merged)")
+            return False
 
-    try:
-        # Read all three versions
-        with open(baseline_path, 'r', encoding='utf-8', errors='ignore') as f:
-            baseline_lines = f.readlines()
-        with open(original_filepath, 'r', encoding='utf-8', errors='ignore') as f:
-            local_lines = f.readlines()
-        with open(conflict_filepath, 'r', encoding='utf-8', errors='ignore') as f:
-            remote_lines = f.readlines()
+        try:
+            # Read all three versions
+            with open(baseline_path, 'r', encoding='utf-8', errors='ignore') as f:
+                baseline_lines = f.readlines()
+            with open(original_filepath, 'r', encoding='utf-8', errors='ignore') as f:
+                local_lines = f.readlines()
+            with open(conflict_filepath, 'r', encoding='utf-8', errors='ignore') as f:
+                remote_lines = f.readlines()
 
-        # Perform three-way merge
-        has_conflicts, conflict_line_nums = detect_conflicts(baseline_lines, local_lines, remote_lines)
-        merged_lines = perform_three_way_merge(baseline_lines, local_lines, remote_lines)
+            # Perform three-way merge
+            merged_lines, conflict_line_nums = merge_lines(baseline_lines, local_lines, remote_lines)
+            has_conflicts = len(conflict_line_nums) > 0
 
-        if has_conflicts:
-            # Save backups for manual resolution
-            local_backup = Path(f"{original_filepath}.local_backup")
-            remote_backup = Path(f"{original_filepath}.remote_backup")
-            pre_merge_backup = Path(f"{original_filepath}.pre_merge_backup")
+            if has_conflicts:
+                # Save backups for manual resolution
+                local_backup = Path(f"{original_filepath}.local_backup")
+                remote_backup = Path(f"{original_filepath}.remote_backup")
+                pre_merge_backup = Path(f"{original_filepath}.pre_merge_backup")
 
-            shutil.copy2(original_filepath, local_backup)
-            shutil.copy2(conflict_filepath, remote_backup)
-            shutil.copy2(original_filepath, pre_merge_backup)
+                shutil.copy2(original_filepath, local_backup)
+                shutil.copy2(conflict_filepath, remote_backup)
+                shutil.copy2(original_filepath, pre_merge_backup)
 
-            # Write the merged version (with conflict markers if any)
-            with open(original_filepath, 'w', encoding='utf-8') as f:
-                f.writelines(merged_lines)
+                # Write the merged version (with conflict markers if any)
+                with open(original_filepath, 'w', encoding='utf-8') as f:
+                    f.writelines(merged_lines)
 
-            notify("Dropbox Conflict - Manual Resolution Needed",
-                   f"{Path(original_filepath).name}\n"
-                   f"Conflicts detected at lines: {', '.join(map(str, conflict_line_nums[:5]))}\n"
-                   f"Backup files created for manual resolution.")
+                notify("Dropbox Conflict - Manual Resolution Needed",
+                       f"{Path(original_filepath).name}\n"
+                       f"Conflicts detected at lines: {', '.join(map(str, conflict_line_nums[:5]))}\n"
+                       f"Backup files created for manual resolution.")
 
-            # Remove the Dropbox conflict file
-            try:
-                Path(conflict_filepath).unlink()
-            except:
-                pass
+                # Remove the Dropbox conflict file
+                try:
+                    Path(conflict_filepath).unlink()
+                except:
+                    pass
+
+                return False
+            else:
+                # No conflicts, auto-merge successful
+                with open(original_filepath, 'w', encoding='utf-8') as f:
+                    f.writelines(merged_lines)
+
+                # Remove the Dropbox conflict file
+                try:
+                    Path(conflict_filepath).unlink()
+                    notify("Dropbox Conflict Auto-Merged",
+                           f"{Path(original_filepath).name}\n"
+                           f"Changes from conflict file merged successfully.")
+                    return True
+                except Exception as e:
+                    notify("Dropbox Conflict - Merge Warning",
+                           f"{Path(original_filepath).name}\n"
+                           f"Merged but couldn't remove conflict file: {str(e)}")
+                    return False
 
+        except Exception as e:
+            notify("Dropbox Conflict - Merge Error",
+                   f"{Path(conflict_filepath).name}\n"
+                   f"Error during merge: {str(e)}")
             return False
-        else:
-            # No conflicts, auto-merge successful
-            with open(original_filepath, 'w', encoding='utf-8') as f:
-                f.writelines(merged_lines)
 
-            # Remove the Dropbox conflict file
-            try:
-                Path(conflict_filepath).unlink()
-                notify("Dropbox Conflict Auto-Merged",
-                       f"{Path(original_filepath).name}\n"
-                       f"Changes from conflict file merged successfully.")
-                return True
-            except Exception as e:
-                notify("Dropbox Conflict - Merge Warning",
-                       f"{Path(original_filepath).name}\n"
-                       f"Merged but couldn't remove conflict file: {str(e)}")
-                return False
 
-    except Exception as e:
-        notify("Dropbox Conflict - Merge Error",
-               f"{Path(conflict_filepath).name}\n"
-               f"Error during merge: {str(e)}")
-        return False
+def tokenize_line(line):
+    """Split a line into word and punctuation tokens (joining them gives the line back)"""
+    return WORD_TOKEN_RE.findall(line)
 
 
-def detect_conflicts(baseline_lines, local_lines, remote_lines):
-    """
-    Detect conflicts between local and remote changes.
-    Returns: (has_conflicts, conflicting_line_numbers)
-    """
-    conflicts = []
+def get_token_edits(baseline_tokens, changed_tokens):
+    """Return the edits turning baseline_tokens into changed_tokens as (start, end, replacement) tuples"""
+    matcher = SequenceMatcher(None, baseline_tokens, changed_tokens, autojunk=False)
+    return [(i1, i2, tuple(changed_tokens[j1:j2]))
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != "equal"]
+
 
-    # Find lines that changed in both versions
-    for i in range(max(len(baseline_lines), len(local_lines), len(remote_lines))):
-        baseline_line = baseline_lines[i] if i < len(baseline_lines) else ""
-        local_line = local_lines[i] if i < len(local_lines) else ""
-        remote_line = remote_lines[i] if i < len(remote_lines) else ""
+def edits_overlap(a, b):
+    """Check if two token edits touch the same baseline span (adjacent insertions count as overlapping)"""
+    if a[0] == a[1] or b[0] == b[1]:
+        # Insertions conflict with anything at or around their position
+        return a[0] <= b[1] and b[0] <= a[1]
+    return a[0] < b[1] and b[0] < a[1]
 
-        # Both changed the same line differently
-        if baseline_line != local_line and baseline_line != remote_line:
-            if local_line != remote_line:
-                conflicts.append(i)
 
-    return len(conflicts) > 0, conflicts
+def merge_line_words(baseline_line, local_line, remote_line, max_cost=WORD_MERGE_MAX_COST):
+    """
+    Three-way merge of a single line at word level.
+    LyX keeps a whole paragraph on one line, so two people editing different
+    sentences change the same line. Returns the merged line if the word-level
+    edits are disjoint, or None if they overlap or the line is too long to diff cheaply.
+    """
+    if baseline_line is None or local_line is None or remote_line is None:
+        return None
+
+    baseline = tokenize_line(baseline_line)
+    local = tokenize_line(local_line)
+    remote = tokenize_line(remote_line)
+
+    # Only the span between the common prefix and suffix needs diffing
+    prefix = 0
+    limit = min(len(baseline), len(local), len(remote))
+    while prefix < limit and baseline[prefix] == local[prefix] == remote[prefix]:
+        prefix += 1
+    suffix = 0
+    limit -= prefix
+    while (suffix < limit and
+           baseline[-1 - suffix] == local[-1 - suffix] == remote[-1 - suffix]):
+        suffix += 1
+
+    end = len(baseline) - suffix
+    base_mid = baseline[prefix:end]
+    local_mid = local[prefix:len(local) - suffix]
+    remote_mid = remote[prefix:len(remote) - suffix]
+    if len(base_mid) * max(len(local_mid), len(remote_mid)) > max_cost:
+        return None  # Cost cap - treat as a normal line conflict
+
+    local_edits = get_token_edits(base_mid, local_mid)
+    remote_edits = get_token_edits(base_mid, remote_mid)
+    for a in local_edits:
+        for b in remote_edits:
+            if a == b:
+                continue  # Both made the same edit
+            if edits_overlap(a, b):
+                return None
+
+    # Apply both sets of edits (identical edits only once) from left to right
+    merged = list(baseline[:prefix])
+    position = 0
+    for i1, i2, replacement in sorted(set(local_edits) | set(remote_edits)):
+        merged.extend(base_mid[position:i1])
+        merged.extend(replacement)
+        position = i2
+    merged.extend(base_mid[position:])
+    merged.extend(baseline[end:])
+    return "".join(merged)
+
+
+def aligned_lines(baseline_lines, changed_lines):
+    """
+    Indices where `changed_lines` still holds the counterpart of the baseline line at the
+    same index (unchanged or edited in place, not shifted by an insertion or deletion)
+    """
+    matcher = SequenceMatcher(None, baseline_lines, changed_lines, autojunk=False)
+    aligned = set()
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag in ("equal", "replace") and i1 == j1 and i2 == j2:
+            aligned.update(range(i1, i2))
+    return aligned
 
 
-def perform_three_way_merge(baseline_lines, local_lines, remote_lines):
+def merge_lines(baseline_lines, local_lines, remote_lines):
     """
     Perform a three-way merge of baseline, local, and remote versions.
-    Returns: merged_lines (list of strings)
+    Lines both sides changed differently are merged word by word where possible.
+    Outcomes are memoized by content hash, so re-merging identical versions is free.
+    Returns: (merged_lines, conflicting_line_numbers)
     """
-    merged_lines = []
+    key = (hash_lines(baseline_lines), hash_lines(local_lines), hash_lines(remote_lines))
+    cached = merge_cache.get(key)
+    if cached is not None:
+        return list(cached[0]), list(cached[1])
+
+    # Only the lines between the chunks all three versions share need merging
+    prefix, suffix = common_chunks([(baseline_lines, get_chunks(baseline_lines, key[0])),
+                                    (local_lines, get_chunks(local_lines, key[1])),
+                                    (remote_lines, get_chunks(remote_lines, key[2]))])
+    head = baseline_lines[:prefix]
+    tail = baseline_lines[len(baseline_lines) - suffix:] if suffix else []
+    baseline_lines = baseline_lines[prefix:len(baseline_lines) - suffix]
+    local_lines = local_lines[prefix:len(local_lines) - suffix]
+    remote_lines = remote_lines[prefix:len(remote_lines) - suffix]
+
+    merged_lines = head
+    conflicts = []
+    alignment = None  # Computed once a line needs a word merge
     max_len = max(len(baseline_lines), len(local_lines), len(remote_lines))
 
     for i in range(max_len):
@@ -484,14 +1316,26 @@ def perform_three_way_merge(baseline_lines, local_lines, remote_lines):
             if local_line is not None:
                 merged_lines.append(local_line)
         else:
-            # Both changed but we already checked for conflicts
-            # This shouldn't happen, but default to local
+            # Both changed the same line differently - try merging the words,
+            # but only if both sides still hold this baseline paragraph at index i
+            if alignment is None:
+                alignment = (aligned_lines(baseline_lines, local_lines) &
+                             aligned_lines(baseline_lines, remote_lines))
+            if i in alignment:
+                merged_line = merge_line_words(baseline_line, local_line, remote_line)
+                if merged_line is not None:
+                    merged_lines.append(merged_line)
+                    continue
+            conflicts.append(prefix + i)
+            # Default to local
             if local_line is not None:
                 merged_lines.append(local_line)
             elif remote_line is not None:
                 merged_lines.append(remote_line)
 
-    return merged_lines
+    merged_lines.extend(tail)
+    merge_cache.put(key, (tuple(merged_lines), tuple(conflicts)))
+    return merged_lines, conflicts
 
 
 def merge_files(filepath, local_version_path=None):
@@ -533,9 +1377,9 @@ def merge_files(filepath, local_version_path=None):
             # We haven't made local changes, so just accept remote
             return ('success', 'No local changes - accepting remote version')
 
-        # Both changed - need to merge
-        # Detect conflicts
-        has_conflicts, conflict_lines = detect_conflicts(baseline_lines, local_lines, remote_lines)
+        # Both changed - merge and detect conflicts in one pass
+        merged_lines, conflict_lines = merge_lines(baseline_lines, local_lines, remote_lines)
+        has_conflicts = len(conflict_lines) > 0
 
         if has_conflicts:
             # Create backups for manual resolution
@@ -550,10 +1394,7 @@ def merge_files(filepath, local_version_path=None):
                     f'Conflicts detected at {len(conflict_lines)} line(s).\n'
                     f'Backups created:\n{backup_remote.name}\n{backup_local.name}')
 
-        # No conflicts - perform merge
-        merged_lines = perform_three_way_merge(baseline_lines, local_lines, remote_lines)
-
-        # Create backup before merging
+        # No conflicts - create backup before merging
         backup_path = Path(f"{filepath}.pre_merge_backup")
         shutil.copy2(filepath, backup_path)
 
@@ -569,329 +1410,1453 @@ def merge_files(filepath, local_version_path=None):
         return ('error', f'Merge error: {str(e)}')
 
 
+class LyXServerError(Exception):
+    pass
+
+
+class LyXServerClient:
+    """
+    Minimal client for the LyX server pipes.
+    LyX reads commands from <base>.in and answers on <base>.out:
+      LYXCMD:<client>:<function>:<argument>
+      INFO:<client>:<function>:<data>  or  ERROR:<client>:<function>:<message>
+    """
+
+    def __init__(self, pipe_base, timeout=LYXSERVER_TIMEOUT, client_name=LYXSERVER_CLIENT):
+        self.pipe_base = pipe_base
+        self.timeout = timeout
+        self.client_name = client_name
+
+    def send(self, function, argument=""):
+        """Send an LFUN and wait for its reply. Returns the INFO data, raises LyXServerError otherwise."""
+        command = f"LYXCMD:{self.client_name}:{function}:{argument}\n".encode("utf-8")
+        if sys.platform == "win32":
+            reply = self._send_windows(command, function)
+        else:
+            reply = self._send_posix(command, function)
+        kind, data = reply
+        if kind != "INFO":
+            raise LyXServerError(f"{function}: {data}")
+        return data
+
+    def _match_reply(self, line, function):
+        for kind in ("INFO", "ERROR"):
+            prefix = f"{kind}:{self.client_name}:{function}:"
+            if line.startswith(prefix):
+                return kind, line[len(prefix):]
+        return None
+
+    def _send_posix(self, command, function):
+        # Open the reply pipe first so we can't miss the answer
+        out_fd = os.open(f"{self.pipe_base}.out", os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            try:
+                # Fails with ENXIO if no LyX is reading the pipe
+                in_fd = os.open(f"{self.pipe_base}.in", os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                raise LyXServerError(f"LyX server not running: {e}")
+            try:
+                os.write(in_fd, command)
+            finally:
+                os.close(in_fd)
+
+            deadline = time.time() + self.timeout
+            buffer = b""
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise LyXServerError(f"{function}: no reply within {self.timeout}s")
+                ready, _, _ = select.select([out_fd], [], [], remaining)
+                if not ready:
+                    continue
+                chunk = os.read(out_fd, 4096)
+                if not chunk:
+                    # No writer attached right now - wait a moment instead of spinning
+                    time.sleep(0.01)
+                    continue
+                buffer += chunk
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    reply = self._match_reply(line.decode("utf-8", errors="replace"), function)
+                    if reply:
+                        return reply
+        finally:
+            os.close(out_fd)
+
+    def _send_windows(self, command, function):
+        # Named pipes (\\.\pipe\...) can't be select()ed - read replies in a helper thread
+        result = []
+
+        def read_reply():
+            try:
+                with open(f"{self.pipe_base}.out", "rb") as out:
+                    for line in out:
+                        reply = self._match_reply(line.decode("utf-8", errors="replace").rstrip("\r\n"), function)
+                        if reply:
+                            result.append(reply)
+                            return
+            except OSError:
+                pass
+
+        reader = threading.Thread(target=read_reply, daemon=True)
+        reader.start()
+        try:
+            with open(f"{self.pipe_base}.in", "wb") as pipe_in:
+                pipe_in.write(command)
+        except OSError as e:
+            raise LyXServerError(f"LyX server not running: {e}")
+        reader.join(self.timeout)
+        if not result:
+            raise LyXServerError(f"{function}: no reply within {self.timeout}s")
+        return result[0]
+
+
+def get_lyx_preference_files():
+    """Return candidate LyX user preference files, newest LyX version first"""
+    home = Path.home()
+    if sys.platform == "win32":
+        user_dirs = list(Path(os.getenv("APPDATA", home)).glob("LyX*"))
+    elif sys.platform == "darwin":
+        user_dirs = list((home / "Library" / "Application Support").glob("LyX*"))
+    else:
+        user_dirs = list(home.glob(".lyx*")) + list((home / ".config").glob("lyx*"))
+    return [d / "preferences" for d in sorted(user_dirs, reverse=True) if (d / "preferences").is_file()]
+
+
+def find_lyxserver_pipe():
+    """
+    Locate the lyxserver pipe base path (without .in/.out).
+    Uses the configured "lyxpipe" if set, otherwise the \\serverpipe entry of the LyX preferences.
+    """
+    candidates = []
+    if state.get("lyxpipe"):
+        candidates.append(state["lyxpipe"])
+    else:
+        for prefs in get_lyx_preference_files():
+            try:
+                match = re.search(r'^\\serverpipe\s+"([^"]+)"', prefs.read_text(errors="ignore"), re.MULTILINE)
+            except OSError:
+                continue
+            if match:
+                candidates.append(match.group(1))
+
+    for base in candidates:
+        base = os.path.expanduser(base)
+        if sys.platform == "win32" and base.startswith("\\\\.\\pipe\\"):
+            return base
+        if os.path.exists(f"{base}.in") and os.path.exists(f"{base}.out"):
+            return base
+    return None
+
+
+def reload_lyx_buffer(filepath):
+    """
+    Ask the running LyX to reload `filepath` from disk after we merged into it.
+    Returns True if LyX confirmed the reload, False if the lyxserver isn't available.
+    """
+    pipe_base = find_lyxserver_pipe()
+    if not pipe_base:
+        return False
+
+    client = LyXServerClient(pipe_base)
+    try:
+        try:
+            current = client.send("server-get-filename")
+        except LyXServerError:
+            current = ""
+        client.send("buffer-switch", filepath)
+        client.send("buffer-reload")
+        # Go back to whatever document the user was looking at
+        if current and Path(current) != Path(filepath):
+            client.send("buffer-switch", current)
+        return True
+    except (LyXServerError, OSError):
+        return False
+
+
+def reload_and_notify(filepath, title, message, reloaded_hint, manual_hint):
+    """
+    Ask LyX to reload a merged document, then notify. Runs in the background pool,
+    outside the document lock, so an unresponsive LyX can't stall the monitor.
+    """
+    hint = reloaded_hint if reload_lyx_buffer(filepath) else manual_hint
+    notify(title, f"{message}\n{hint}")
+
+
 def perform_merge_on_save(filepath):
     """
     Perform a merge when a file is saved while merge-on-save is enabled.
     Returns True if merge was performed, False otherwise.
     """
-    baseline_path = Path(f"{filepath}{BASELINE_SUFFIX}")
+    with document_lock(filepath):
+        baseline_path = Path(f"{filepath}{BASELINE_SUFFIX}")
 
-    # Check if we have a baseline
-    if not baseline_path.exists():
-        return False
+        # Check if we have a baseline
+        if not baseline_path.exists():
+            return False
 
-    try:
-        # Read baseline
-        with open(baseline_path, 'r', encoding='utf-8', errors='replace') as f:
-            baseline_lines = f.readlines()
+        try:
+            # Read baseline
+            with open(baseline_path, 'r', encoding='utf-8', errors='replace') as f:
+                baseline_lines = f.readlines()
 
-        # Read current file (has our local changes)
-        with open(filepath, 'r', encoding='utf-8', errors='replace') as f:
-            local_lines = f.readlines()
+            # Read current file (has our local changes)
+            with open(filepath, 'r', encoding='utf-8', errors='replace') as f:
+                local_lines = f.readlines()
+
+            # Check if baseline is different from local (we made changes)
+            if local_lines == baseline_lines:
+                # No local changes, nothing to merge
+                return False
+
+            # Check if there's a pending remote version
+            with state_lock:
+                doc = state["documents"].get(filepath)
+                remote_backup_path = doc.pending_merge if doc is not None else None
+
+            if remote_backup_path:
+                if Path(remote_backup_path).exists():
+                    # Read remote version
+                    with open(remote_backup_path, 'r', encoding='utf-8', errors='replace') as f:
+                        remote_lines = f.readlines()
+
+                    # Perform three-way merge
+                    merged_lines, conflict_lines = merge_lines(baseline_lines, local_lines, remote_lines)
+                    has_conflicts = len(conflict_lines) > 0
+
+                    if has_conflicts:
+                        # Create backups for manual resolution
+                        backup_remote = Path(f"{filepath}.remote_backup")
+                        backup_local = Path(f"{filepath}.local_backup")
+                        backup_pre = Path(f"{filepath}.pre_merge_backup")
+
+                        shutil.copy2(filepath, backup_local)
+                        shutil.copy2(remote_backup_path, backup_remote)
+                        shutil.copy2(filepath, backup_pre)
+
+                        # Write merged version anyway (may have conflict markers)
+                        with open(filepath, 'w', encoding='utf-8') as f:
+                            f.writelines(merged_lines)
+
+                        background_pool.submit(
+                            reload_and_notify, filepath, "Merge on Save - Conflicts Detected",
+                            f"{Path(filepath).name}\nConflicts at {len(conflict_lines)} line(s).",
+                            "Reloaded in LyX - please resolve manually.",
+                            "Please reload the file in LyX and resolve manually.")
+
+                        # Clean up remote backup
+                        try:
+                            Path(remote_backup_path).unlink()
+                        except:
+                            pass
+                        take_pending_merge(filepath)
+
+                        return True
+                    else:
+                        # No conflicts - auto-merge successful
+                        with open(filepath, 'w', encoding='utf-8') as f:
+                            f.writelines(merged_lines)
+
+                        # Update baseline to merged version
+                        create_baseline(filepath)
+
+                        background_pool.submit(
+                            reload_and_notify, filepath, "Merge on Save - Success",
+                            f"{Path(filepath).name}\nRemote changes merged successfully.",
+                            "Reloaded in LyX.",
+                            "Please reload the file in LyX (File > Revert).")
+
+                        # Clean up remote backup
+                        try:
+                            Path(remote_backup_path).unlink()
+                        except:
+                            pass
+                        take_pending_merge(filepath)
+
+                        return True
 
-        # Check if baseline is different from local (we made changes)
-        if local_lines == baseline_lines:
-            # No local changes, nothing to merge
             return False
 
-        # Check if there's a pending remote version
-        if filepath in state["pending_merges"]:
-            remote_backup_path = state["pending_merges"][filepath]
+        except Exception as e:
+            notify("Merge on Save - Error",
+                   f"{Path(filepath).name}\n"
+                   f"Error during merge: {str(e)}")
+            return False
 
-            if Path(remote_backup_path).exists():
-                # Read remote version
-                with open(remote_backup_path, 'r', encoding='utf-8', errors='replace') as f:
-                    remote_lines = f.readlines()
 
-                # Perform three-way merge
-                has_conflicts, conflict_lines = detect_conflicts(baseline_lines, local_lines, remote_lines)
-                merged_lines = perform_three_way_merge(baseline_lines, local_lines, remote_lines)
+# inotify constants (see <sys/inotify.h>)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000  # Kernel queue overflowed, events were lost
+IN_IGNORED = 0x00008000  # Watch was removed (folder deleted/moved, filesystem unmounted)
+IN_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
 
-                if has_conflicts:
-                    # Create backups for manual resolution
-                    backup_remote = Path(f"{filepath}.remote_backup")
-                    backup_local = Path(f"{filepath}.local_backup")
-                    backup_pre = Path(f"{filepath}.pre_merge_backup")
 
-                    shutil.copy2(filepath, backup_local)
-                    shutil.copy2(remote_backup_path, backup_remote)
-                    shutil.copy2(filepath, backup_pre)
+class SaveWatcher:
+    """
+    Deliver save events for locked documents as soon as LyX writes them.
+    Uses inotify close-write/moved-to events on the parent folders on Linux
+    (LyX saves either in place or via rename). Files without a working watch
+    (other platforms, or inotify_add_watch failing e.g. with ENOSPC once
+    max_user_watches is used up) are polled for st_mtime once per POLL_INTERVAL.
+    """
 
-                    # Write merged version anyway (may have conflict markers)
-                    with open(filepath, 'w', encoding='utf-8') as f:
-                        f.writelines(merged_lines)
+    def __init__(self, callback):
+        self.callback = callback
+        self.files = set()
+        self.polled = set()  # Watched files that have no inotify watch
+        self.warned = False
+        self.dir_watches = {}  # {folder: watch descriptor}
+        self.wd_dirs = {}  # {watch descriptor: folder}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.inotify_fd = None
+        self.libc = None
+        if sys.platform.startswith("linux"):
+            self._init_inotify()
+
+    def _init_inotify(self):
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0:
+                self.inotify_fd = fd
+                # Self-pipe so stop() can wake the blocking select()
+                self.wake_r, self.wake_w = os.pipe()
+        except (OSError, AttributeError):
+            self.inotify_fd = None
+
+    def start(self):
+        if self.inotify_fd is not None:
+            threading.Thread(target=self._inotify_loop, daemon=True).start()
+        threading.Thread(target=self._poll_loop, daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.inotify_fd is not None:
+            try:
+                os.write(self.wake_w, b"x")
+            except OSError:
+                pass
 
-                    notify("Merge on Save - Conflicts Detected",
-                           f"{Path(filepath).name}\n"
-                           f"Conflicts at {len(conflict_lines)} line(s).\n"
-                           f"Please reload the file in LyX and resolve manually.")
+    def _add_dir_watch(self, folder):
+        """Watch `folder` with inotify (call with self.lock held). Returns False if that failed"""
+        if self.inotify_fd is None:
+            return False
+        if folder in self.dir_watches:
+            return True
+        wd = self.libc.inotify_add_watch(self.inotify_fd, os.fsencode(folder), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if not self.warned:
+                self.warned = True
+                notify("DropLyx - Save Detection",
+                       f"Can't watch {folder} for saves ({os.strerror(error)}).\n"
+                       f"Polling instead (raise fs.inotify.max_user_watches if this persists).")
+            return False
+        self.dir_watches[folder] = wd
+        self.wd_dirs[wd] = folder
+        return True
 
-                    # Clean up remote backup
-                    try:
-                        Path(remote_backup_path).unlink()
-                    except:
-                        pass
-                    state["pending_merges"].pop(filepath, None)
+    def watch(self, filepath):
+        folder = os.path.dirname(filepath)
+        with self.lock:
+            self.files.add(filepath)
+            if self._add_dir_watch(folder):
+                self.polled.discard(filepath)
+            else:
+                self.polled.add(filepath)
+
+    def unwatch(self, filepath):
+        folder = os.path.dirname(filepath)
+        with self.lock:
+            self.files.discard(filepath)
+            self.polled.discard(filepath)
+            if folder in self.dir_watches and not any(os.path.dirname(f) == folder for f in self.files):
+                wd = self.dir_watches.pop(folder)
+                self.wd_dirs.pop(wd, None)
+                if self.inotify_fd is not None:
+                    self.libc.inotify_rm_watch(self.inotify_fd, wd)
+
+    def _inotify_loop(self):
+        while not self.stopped.is_set():
+            # Block until the kernel has events for us - no timeouts, no idle stat calls
+            ready, _, _ = select.select([self.inotify_fd, self.wake_r], [], [])
+            if self.wake_r in ready:
+                break
+            try:
+                data = os.read(self.inotify_fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+
+            saved = []
+            offset = 0
+            while offset + IN_EVENT_HEADER.size <= len(data):
+                wd, mask, _, name_len = IN_EVENT_HEADER.unpack_from(data, offset)
+                offset += IN_EVENT_HEADER.size
+                name = data[offset:offset + name_len].rstrip(b"\0")
+                offset += name_len
+                with self.lock:
+                    if mask & IN_Q_OVERFLOW:
+                        # Events were dropped - report every file, the callback checks mtimes
+                        saved.extend(f for f in self.files if f not in saved)
+                        continue
+                    if mask & IN_IGNORED:
+                        self._rewatch(wd)
+                        continue
+                    folder = self.wd_dirs.get(wd)
+                    if folder is None or not name:
+                        continue
+                    filepath = os.path.join(folder, os.fsdecode(name))
+                    if filepath in self.files and filepath not in saved:
+                        saved.append(filepath)
+
+            for filepath in saved:
+                self.callback(filepath)
+
+    def _rewatch(self, wd):
+        """The kernel dropped watch `wd`: add it again, or poll its files (call with self.lock held)"""
+        folder = self.wd_dirs.pop(wd, None)
+        if folder is None or self.dir_watches.get(folder) != wd:
+            return  # Removed by unwatch()
+        del self.dir_watches[folder]
+        files = [f for f in self.files if os.path.dirname(f) == folder]
+        if files and not self._add_dir_watch(folder):
+            self.polled.update(files)
+
+    def _poll_loop(self):
+        mtimes = {}
+        while not self.stopped.wait(POLL_INTERVAL):
+            with self.lock:
+                files = list(self.polled)
+            for filepath in files:
+                try:
+                    mtime = os.stat(filepath).st_mtime
+                except OSError:
+                    continue
+                last = mtimes.get(filepath)
+                mtimes[filepath] = mtime
+                if last is not None and mtime > last:
+                    self.callback(filepath)
+            for filepath in list(mtimes):
+                if filepath not in files:
+                    mtimes.pop(filepath)
+
+
+def on_document_saved(filepath):
+    """
+    Handle a save event for a locked document (called from the SaveWatcher thread).
+    With merge-on-save enabled, pending remote changes are merged right away.
+    """
+    try:
+        current_mtime = Path(filepath).stat().st_mtime
+    except OSError:
+        return
+    with state_lock:
+        doc = state["documents"].get(filepath)
+        if doc is None or not doc.mine:
+            return
+        last_mtime = doc.mtime
+        doc.mtime = current_mtime
+        has_pending = doc.pending_merge is not None
+    if last_mtime is not None and current_mtime <= last_mtime:
+        return  # Nothing new was written
 
-                    return True
-                else:
-                    # No conflicts - auto-merge successful
-                    with open(filepath, 'w', encoding='utf-8') as f:
-                        f.writelines(merged_lines)
+    if state.get("merge_on_save", False) and has_pending:
+        perform_merge_on_save(filepath)
 
-                    notify("Merge on Save - Success",
-                           f"{Path(filepath).name}\n"
-                           f"Remote changes merged successfully.\n"
-                           f"Please reload the file in LyX (File > Revert).")
 
-                    # Update baseline to merged version
-                    create_baseline(filepath)
+def create_lock(filepath):
+    with document_lock(filepath):
+        lock_file = Path(f"{filepath}{LOCK_SUFFIX}")
+        if not observe("lock_exists", filepath, lock_file.exists) and not held_by_other(filepath):
+            if not replaying():
+                # Fall back to a lock file when the manifest can't list this document
+                if not (state["presence_manifest"] and update_presence(filepath, True)):
+                    lock_file.write_text(get_username())
+            with state_lock:
+                get_document(filepath).mine = True
+                lock_status_changed()
+            # Create baseline for merge tracking
+            create_baseline(filepath)
+            # Initialize modification time tracking for merge-on-save
+            try:
+                mtime = Path(filepath).stat().st_mtime
+                with state_lock:
+                    get_document(filepath).mtime = mtime
+            except:
+                pass
+            if state["save_watcher"]:
+                state["save_watcher"].watch(filepath)
+
 
-                    # Clean up remote backup
+def remove_lock(filepath):
+    with document_lock(filepath):
+        if replaying():
+            # Dry run: only forget the lock, no files are touched and nothing is merged
+            with state_lock:
+                doc = state["documents"].get(filepath)
+                if doc is not None and doc.mine:
+                    doc.mine = False
+                    lock_status_changed()
+            take_pending_merge(filepath)
+            remove_baseline(filepath)
+            return
+        lock_file = Path(f"{filepath}{LOCK_SUFFIX}")
+        if lock_file.exists():
+            try:
+                lock_file.unlink()
+            except:
+                pass
+        update_presence(filepath, False)
+        with state_lock:
+            doc = state["documents"].get(filepath)
+            if doc is not None and doc.mine:
+                doc.mine = False
+                lock_status_changed()
+        remote_backup = take_pending_merge(filepath)
+        if state["save_watcher"]:
+            state["save_watcher"].unwatch(filepath)
+
+        # Check if there's a pending merge
+        if remote_backup:
+
+            # Now we have:
+            # - Baseline: original file
+            # - Remote: the remote_backup file (changes from other user)
+            # - Local: current file (our changes)
+
+            # Save our current version as local backup
+            local_backup = Path(f"{filepath}.local_version")
+            try:
+                shutil.copy2(filepath, local_backup)
+
+                # Copy remote version back to main file for merging
+                shutil.copy2(remote_backup, filepath)
+
+                # Attempt merge
+                status, message = merge_files(filepath, str(local_backup))
+
+                if status == 'success':
+                    notify("LyX Sync - Merge Successful",
+                           f"{Path(filepath).name}:\n{message}")
+                    # Clean up backup files
                     try:
-                        Path(remote_backup_path).unlink()
+                        Path(remote_backup).unlink()
+                        local_backup.unlink()
                     except:
                         pass
-                    state["pending_merges"].pop(filepath, None)
+                elif status == 'conflict':
+                    notify("LyX Sync - Merge Conflicts",
+                           f"{Path(filepath).name}:\n{message}\n\n"
+                           f"Please review and resolve conflicts manually.")
+                else:
+                    notify("LyX Sync - Merge Error",
+                           f"{Path(filepath).name}:\n{message}")
 
-                    return True
+            except Exception as e:
+                notify("LyX Sync - Merge Error",
+                       f"Could not merge {Path(filepath).name}:\n{str(e)}")
 
-        return False
+        # Clean up modification time tracking
+        with state_lock:
+            doc = state["documents"].get(filepath)
+            if doc is not None:
+                doc.mtime = None
 
-    except Exception as e:
-        notify("Merge on Save - Error",
-               f"{Path(filepath).name}\n"
-               f"Error during merge: {str(e)}")
-        return False
+        # Remove baseline when done editing
+        remove_baseline(filepath)
 
 
-def create_lock(filepath):
-    lock_file = Path(f"{filepath}{LOCK_SUFFIX}")
-    if not lock_file.exists():
-        lock_file.write_text(get_username())
-        state["my_locks"].add(filepath)
-        # Create baseline for merge tracking
-        create_baseline(filepath)
-        # Initialize modification time tracking for merge-on-save
-        try:
-            state["file_mtimes"][filepath] = Path(filepath).stat().st_mtime
-        except:
-            pass
+def watch_root_of(filepath):
+    """
+    The watch folder containing `filepath` (the innermost one) and the "/"-separated path
+    of the file inside it, or (None, None). Paths are compared resolved, so symlinked or
+    differently spelled watch folders still match.
+    """
+    real = os.path.realpath(filepath)
+    best = (None, None)
+    best_len = -1
+    for root in get_watch_dirs():
+        real_root = os.path.realpath(root)
+        if real.startswith(os.path.join(real_root, "")) and len(real_root) > best_len:
+            best = (root, relative_path(real_root, real))
+            best_len = len(real_root)
+    return best
 
 
-def remove_lock(filepath):
-    lock_file = Path(f"{filepath}{LOCK_SUFFIX}")
-    if lock_file.exists():
-        try:
-            lock_file.unlink()
-        except:
-            pass
-    state["my_locks"].discard(filepath)
+def presence_manifest_name(user=None, device=None):
+    """One manifest per user and device: the same user may hold documents on several machines"""
+    user = re.sub(r"[^\w.-]", "_", user or get_username())
+    device = re.sub(r"[^\w.-]", "_", device or get_device_id())
+    return f"{user}@{device}.json"
 
-    # Check if there's a pending merge
-    if filepath in state["pending_merges"]:
-        remote_backup = state["pending_merges"][filepath]
 
-        # Now we have:
-        # - Baseline: original file
-        # - Remote: the remote_backup file (changes from other user)
-        # - Local: current file (our changes)
+def presence_manifest_path(root):
+    return Path(root) / PRESENCE_DIR / presence_manifest_name()
 
-        # Save our current version as local backup
-        local_backup = Path(f"{filepath}.local_version")
-        try:
-            shutil.copy2(filepath, local_backup)
 
-            # Copy remote version back to main file for merging
-            shutil.copy2(remote_backup, filepath)
+def write_presence(root, held):
+    """Atomically write our presence manifest for a watch folder"""
+    manifest = presence_manifest_path(root)
+    manifest.parent.mkdir(exist_ok=True)
+    # Replace atomically so readers (and Dropbox) never see half a manifest
+    tmp = manifest.with_name(f"{manifest.name}.tmp")
+    tmp.write_text(json.dumps({"user": get_username(), "device": get_device_id(), "documents": sorted(held)},
+                              indent=1))
+    os.replace(tmp, manifest)
 
-            # Attempt merge
-            status, message = merge_files(filepath, str(local_backup))
 
-            if status == 'success':
-                notify("LyX Sync - Merge Successful",
-                       f"{Path(filepath).name}:\n{message}")
-                # Clean up backup files
-                try:
-                    Path(remote_backup).unlink()
-                    local_backup.unlink()
-                except:
-                    pass
-            elif status == 'conflict':
-                notify("LyX Sync - Merge Conflicts",
-                       f"{Path(filepath).name}:\n{message}\n\n"
-                       f"Please review and resolve conflicts manually.")
-            else:
-                notify("LyX Sync - Merge Error",
-                       f"{Path(filepath).name}:\n{message}")
+def update_presence(filepath, holding):
+    """
+    Add `filepath` to (or drop it from) our presence manifest for its watch folder.
+    Returns False when the file is outside the watch folders or the manifest could not be written.
+    """
+    root, relpath = watch_root_of(filepath)
+    if root is None:
+        return False
+    with presence_lock:
+        held = state["presence"].setdefault(root, set())
+        if holding == (relpath in held):
+            return True
+        updated = held | {relpath} if holding else held - {relpath}
+        try:
+            write_presence(root, updated)
+        except OSError:
+            return False
+        state["presence"][root] = updated
+    return True
 
-        except Exception as e:
-            notify("LyX Sync - Merge Error",
-                   f"Could not merge {Path(filepath).name}:\n{str(e)}")
 
-        # Remove from pending merges
-        state["pending_merges"].pop(filepath, None)
+def clear_presence():
+    """
+    Empty our own manifests left behind by a previous run (e.g. after a crash)
+    and delete Dropbox's conflicted copies of them
+    """
+    with presence_lock:
+        for root in get_watch_dirs():
+            manifest = presence_manifest_path(root)
+            try:
+                with os.scandir(manifest.parent) as entries:
+                    copies = [e.path for e in entries
+                              if e.name.startswith(f"{manifest.stem} (") and e.name.endswith(".json")]
+                for path in copies:
+                    os.remove(path)
+                if manifest.exists():
+                    write_presence(root, ())
+            except OSError:
+                pass
+            state["presence"][root] = set()
+
+
+def read_presence(root):
+    """Return {filepath: user} for the documents listed in the presence manifests of a watch folder"""
+    holders = {}
+    try:
+        with os.scandir(os.path.join(root, PRESENCE_DIR)) as entries:
+            manifests = [(e.path, e.stat().st_mtime_ns) for e in entries if PRESENCE_MANIFEST_RE.match(e.name)]
+    except OSError:
+        return holders
+    for path, mtime_ns in manifests:
+        # A manifest is only parsed again once it changed
+        manifest = presence_cache.get((path, mtime_ns))
+        if manifest is None:
+            try:
+                data = json.loads(Path(path).read_text())
+                manifest = (data["user"], tuple(data.get("documents", [])))
+            except (OSError, ValueError, KeyError, TypeError):
+                continue  # Unreadable or still syncing - try again next pass
+            presence_cache.put((path, mtime_ns), manifest)
+        user, documents = manifest
+        for relpath in documents:
+            holders[os.path.join(root, *relpath.split("/"))] = user
+    return holders
+
+
+def held_by_other(filepath):
+    """Whether a presence manifest other than this device's lists `filepath` (another user, or us elsewhere)"""
+    root, relpath = watch_root_of(filepath)
+    if root is None:
+        return False
+    user = observe("presence", root, read_presence, root).get(os.path.join(root, *relpath.split("/")))
+    return user is not None and relpath not in state["presence"].get(root, ())
 
-    # Clean up modification time tracking
-    state["file_mtimes"].pop(filepath, None)
 
-    # Remove baseline when done editing
-    remove_baseline(filepath)
+def read_lock_owner(lock_path):
+    try:
+        return Path(lock_path).read_text().strip()
+    except OSError:
+        return None
 
 
-def scan_all_locks():
+def scan_all_locks(scan=None):
+    """
+    Apply the lock files found by `scan` (a TreeScan, or a fresh walk) to the document records.
+    Returns ([(filepath, user)] newly locked, [filepath] unlocked) since the previous scan.
+    """
+    if scan is None:
+        scan = tree_scanner.scan(get_watch_dirs())
+    lyx_paths = {path for _, path, _ in scan.lyx_files}
     locks = {}
-    for d in state["watch_dirs"]:
-        for lock_file in Path(d).rglob(f"*{LOCK_SUFFIX}"):
-            original = str(lock_file)[: -len(LOCK_SUFFIX)]
-            if Path(original).exists():
-                locks[original] = lock_file.read_text().strip()
-    return locks
+    for lock_path, mtime_ns in scan.lock_files:
+        original = lock_path[: -len(LOCK_SUFFIX)]
+        if original in lyx_paths or os.path.exists(original):
+            # Lock contents only change when the lock file does
+            user = lock_owner_cache.get((lock_path, mtime_ns))
+            if user is None:
+                user = observe("lock_owner", lock_path, read_lock_owner, lock_path)
+                if user is None:
+                    continue
+                lock_owner_cache.put((lock_path, mtime_ns), user)
+            locks[original] = user
+
+    # Presence manifests: one small file per user and watch folder instead of a lock per document
+    for root in get_watch_dirs():
+        for filepath, user in observe("presence", root, read_presence, root).items():
+            if filepath not in locks and (filepath in lyx_paths or os.path.exists(filepath)):
+                locks[filepath] = user
+
+    locked, unlocked = [], []
+    with state_lock:
+        changed = False
+        for filepath, user in locks.items():
+            doc = get_document(filepath)
+            if doc.locked_by != user:
+                if doc.locked_by is None:
+                    locked.append((doc.path, user))
+                doc.locked_by = user
+                changed = True
+        for doc in list(state["documents"].values()):
+            if doc.locked_by is not None and doc.path not in locks:
+                doc.locked_by = None
+                unlocked.append(doc.path)
+                changed = True
+                forget_if_idle(doc)
+        if changed:
+            lock_status_changed()
+    return locked, unlocked
+
+
+def check_remote_change(filepath, now):
+    """
+    Check a locked file for changes synced in by Dropbox and snapshot them for merging.
+    Cheap size/mtime check first - only hash once a change has settled,
+    so we never snapshot a file Dropbox is still writing.
+    A document busy with a merge or lock change is skipped until the next pass
+    rather than stalling the whole scan.
+    """
+    lock = document_lock(filepath)
+    acquired = lock.acquire(blocking=False)
+    try:
+        if observe("document_free", filepath, bool, acquired):
+            scan_document(filepath, now)
+    finally:
+        if acquired:
+            lock.release()
+
+
+def scan_document(filepath, now):
+    """check_remote_change for a document whose lock the caller holds"""
+    with state_lock:
+        doc = state["documents"].get(filepath)
+        if doc is None or not doc.mine:
+            return  # Unlocked meanwhile
+        known_signature = doc.signature
+        last_hash = doc.hash
+        baseline_chunks = doc.chunks
+
+    baseline_path = Path(f"{filepath}{BASELINE_SUFFIX}")
+    if not observe("baseline_exists", filepath, baseline_path.exists):
+        return
+    signature = observe("signature", filepath, get_file_signature, filepath)
+    if signature is None or signature == known_signature:
+        with state_lock:
+            state["settling"].pop(filepath, None)
+        return
+    if not has_settled(filepath, signature, now):
+        return
+    with state_lock:
+        doc.signature = signature
+
+    # Check if file changed on disk
+    trace = state["trace"]
+    if trace is not None and trace.replaying:
+        content, current_hash = None, trace.recorded("content_hash", filepath)
+    else:
+        try:
+            content = Path(filepath).read_bytes()
+        except OSError:
+            return
+        current_hash = hashlib.sha256(content).hexdigest()
+        if trace is not None:
+            trace.record("content_hash", filepath, current_hash)
+
+    if current_hash and last_hash and current_hash != last_hash:
+        # File changed on disk while we're editing!
+        # This means someone else edited it and Dropbox synced it
+
+        # Save the remote version for merging later (the exact bytes we hashed)
+        remote_backup = Path(f"{filepath}.remote_version")
+        try:
+            if content is not None:  # None when replaying a trace
+                remote_backup.write_bytes(content)
+                shutil.copystat(filepath, remote_backup)
+            with state_lock:
+                doc.pending_merge = str(remote_backup)
+                # Update the hash
+                doc.hash = current_hash
+
+            # Name the section the remote edit starts in (from the baseline fingerprints)
+            section = None
+            if content is not None and baseline_chunks:
+                lines = io.TextIOWrapper(io.BytesIO(content), encoding="utf-8", errors="replace").readlines()
+                try:
+                    with open(baseline_path, 'r', encoding='utf-8', errors='replace') as f:
+                        baseline_lines = f.readlines()
+                except OSError:
+                    baseline_lines = None
+                section = changed_section(baseline_chunks, lines, baseline_lines)
+            where = f" (section \"{section}\")" if section else ""
+            notify("LyX Sync - Remote Changes!",
+                   f"{Path(filepath).name} was modified by another user{where}.\n"
+                   f"Changes will be merged when you close the file.")
+
+        except Exception as e:
+            notify("LyX Sync - Merge Error",
+                   f"Could not prepare merge for {Path(filepath).name}:\n{str(e)}")
 
 
 def update_tray():
     if not state["icon"]:
         return
-    others = {k: v for k, v in state["locked_files"].items() if k not in state["my_locks"]}
+    # Only redraw when a lock was taken or released since the last draw
+    with state_lock:
+        version = state["status_version"]
+    if version == state["tray_version"]:
+        return
+    mine, others = get_lock_status()
     if others:
         color = "red"
         names = ", ".join(Path(f).name for f in others)
         tip = f"DropLyx — Locked by others: {names}"
-    elif state["my_locks"]:
+    elif mine:
         color = "green"
-        names = ", ".join(Path(f).name for f in state["my_locks"])
+        names = ", ".join(Path(f).name for f in mine)
         tip = f"DropLyx — You editing: {names}"
     else:
         color = "lightblue"
         tip = "DropLyx — Monitoring, no files open"
     state["icon"].icon = create_icon(color)
     state["icon"].title = tip
+    state["tray_version"] = version
+
+
+def get_included_children(filepath):
+    """
+    Return the .lyx documents directly included by `filepath`, i.e.
+    \\begin_inset CommandInset include ... filename "chapter.lyx" ... \\end_inset.
+    Parsed once per file version (size, mtime).
+    """
+    signature = get_file_signature(filepath)
+    if signature is None:
+        return ()
+    cached = include_cache.get(filepath)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+
+    children = []
+    folder = os.path.dirname(filepath)
+    in_include = False
+    try:
+        with open(filepath, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                if line.startswith("\\begin_inset CommandInset include"):
+                    in_include = True
+                elif in_include and line.startswith("\\end_inset"):
+                    in_include = False
+                elif in_include and line.startswith('filename "'):
+                    name = line[len('filename "'):].rstrip().rstrip('"')
+                    if name.endswith(".lyx"):
+                        child = os.path.normpath(os.path.join(folder, name))
+                        if child not in children and os.path.isfile(child):
+                            children.append(child)
+    except OSError:
+        return ()
+
+    children = tuple(children)
+    include_cache.put(filepath, (signature, children))
+    return children
+
+
+def get_document_graph(master):
+    """Return every document reachable from `master` through include insets (master excluded)"""
+    seen = {master}
+    order = []
+    stack = [master]
+    while stack:
+        for child in get_included_children(stack.pop()):
+            if child not in seen:
+                seen.add(child)
+                order.append(child)
+                stack.append(child)
+    return order
+
+
+def create_locks(filepaths):
+    """Lock and baseline a batch of documents (e.g. a master and its chapters) in parallel"""
+    filepaths = list(filepaths)
+    if replaying():
+        # One after the other, so the replay consumes the recorded observations in a fixed order
+        for filepath in filepaths:
+            create_lock(filepath)
+    elif len(filepaths) > 1:
+        list(background_pool.map(create_lock, filepaths))
+    elif filepaths:
+        create_lock(filepaths[0])
+
+
+def close_document(filepath):
+    """Release our lock on a closed document (merging pending remote changes)"""
+    try:
+        remove_lock(filepath)
+    finally:
+        with state_lock:
+            state["closing"].discard(filepath)
+
+
+def monitor_iteration():
+    """One pass of open-file detection, lock bookkeeping, remote-change and conflict checks"""
+    loop_start = time.time()
+
+    detect_start = time.time()
+    open_files = observe("open_files", None, get_lyx_open_files)
+    detect_time = time.time() - detect_start
+
+    # Opening a master document loads its included chapters too
+    open_set = set(open_files)
+    graph_children = {}
+    for master in open_files:
+        for child in observe("graph", master, get_document_graph, master):
+            if child not in open_set:
+                graph_children.setdefault(child, master)
+    with state_lock:
+        state["graph_children"] = graph_children
+    open_graph = open_set | set(graph_children)
+
+    lock_start = time.time()
+    my_locks = set(get_my_locks())
+    create_locks(f for f in sorted(open_graph) if f not in my_locks)
+
+    for f in my_locks:
+        if f not in open_graph:
+            # Unlocking may run a merge - do it in the background
+            with state_lock:
+                if f in state["closing"]:
+                    continue
+                state["closing"].add(f)
+            run_in_background(close_document, f)
+    lock_time = time.time() - lock_start
+
+    total_time = time.time() - loop_start
+
+    # Log timing every 10 loops
+    if int(time.time()) % 10 < 1 and not replaying():
+        with open(TIMING_LOG, 'a') as f:
+            f.write(f"[{datetime.now().strftime('%H:%M:%S')}] Loop: {total_time:.2f}s (detect: {detect_time:.2f}s, locks: {lock_time:.2f}s) - Files: {len(open_files)}\n")
+
+    # One walk of the watch roots serves the lock, conflict and title-index checks
+    watch_dirs = get_watch_dirs()
+    scan = observe("scan", None, tree_scanner.scan, watch_dirs)
+    with state_lock:
+        state["scan_skipped"] = (scan.skipped_dirs, scan.skipped_files)
+    locked, unlocked = scan_all_locks(scan)
+    my_locks = get_my_locks()
+
+    for f, user in locked:
+        if f not in my_locks:
+            notify("LyX Sync", f"{Path(f).name} locked by {user}")
+
+    for f in unlocked:
+        if f not in my_locks:
+            notify("LyX Sync", f"{Path(f).name} unlocked")
+
+    # Check for remote changes on files we're editing
+    now = observe("clock", None, time.time)
+    for filepath in get_my_locks():
+        check_remote_change(filepath, now)
+
+    # Check for Dropbox conflict files in watched directories
+    indexed = []
+    conflicts = []
+    for watch_dir, lyx_file, signature in scan.lyx_files:
+        if is_sync_temp_file(lyx_file):
+            continue
+        indexed.append((watch_dir, lyx_file))
+        if is_dropbox_conflict_file(lyx_file):
+            # Check if we already processed this conflict (by content, so touches
+            # and restarts don't trigger another merge)
+            known_hash = file_hash_cache.get((lyx_file, signature))
+            if known_hash is not None and (lyx_file, known_hash) in processed_conflicts:
+                continue
+            # Wait until Dropbox has finished writing the conflicted copy
+            if not has_settled(lyx_file, signature, now):
+                continue
+            try:
+                conflict_key = (lyx_file, get_cached_file_hash(lyx_file, signature))
+            except Exception:
+                continue  # Ignore errors in conflict detection
+            if conflict_key in processed_conflicts:
+                continue
+            processed_conflicts.put(conflict_key, now)
+            conflicts.append(lyx_file)
+
+    if conflicts:
+        run_in_background(save_processed_conflicts)
+        # Conflicts in documents that are open (or included by an open master) first
+        conflicts.sort(key=lambda c: get_original_file_from_conflict(c) not in open_graph)
+        for conflict in conflicts:
+            # Handle the conflict in the background to avoid blocking
+            run_in_background(handle_dropbox_conflict, conflict)
+
+    # Same walk keeps the window-title index current
+    lyx_index.rebuild(watch_dirs, indexed)
+
+    # Forget settle candidates that vanished before settling (e.g. deleted temp copies)
+    with state_lock:
+        for path in [p for p, (_, seen) in state["settling"].items() if now - seen > 60]:
+            state["settling"].pop(path, None)
+
+
+class ProfileSession:
+    """
+    Profile the next N monitor passes with cProfile, a stack sampler or tracemalloc.
+    Results go to PROFILE_DIR: the raw data (.prof / .folded / .tracemalloc) plus a
+    top-N text summary. Only the monitor passes are covered, not background merges.
+    """
 
+    def __init__(self, mode, passes=PROFILE_PASSES):
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.mode = mode
+        self.remaining = passes
+        self.passes = passes
+        self.started = datetime.now().strftime("%Y%m%d-%H%M%S")
+        self.profile = cProfile.Profile() if mode == "cprofile" else None
+        self.samples = {}  # {folded stack: count}
+        self.sampling = threading.Event()
+        self.sampled_thread = None
+        if mode == "tracemalloc":
+            tracemalloc.start(25)
+        elif mode == "sample":
+            threading.Thread(target=self._sample_loop, daemon=True).start()
+
+    def run(self, func, *args):
+        """Run one monitor pass under the profiler"""
+        try:
+            if self.mode == "cprofile":
+                self.profile.enable()
+                try:
+                    return func(*args)
+                finally:
+                    self.profile.disable()
+            elif self.mode == "sample":
+                self.sampled_thread = threading.get_ident()
+                self.sampling.set()
+                try:
+                    return func(*args)
+                finally:
+                    self.sampling.clear()
+            return func(*args)
+        finally:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.finish()
+
+    def _sample_loop(self):
+        while self.remaining > 0:
+            if not self.sampling.wait(0.5):
+                continue
+            frame = sys._current_frames().get(self.sampled_thread)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                folded = ";".join(reversed(stack))
+                self.samples[folded] = self.samples.get(folded, 0) + 1
+            time.sleep(PROFILE_SAMPLE_INTERVAL)
+
+    def finish(self):
+        """Write the profile and summary, and detach from the monitor"""
+        if state["profiler"] is self:
+            state["profiler"] = None
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        base = PROFILE_DIR / f"droplyx-{self.mode}-{self.started}"
+        summary = io.StringIO()
+        summary.write(f"DropLyx {self.mode} profile of {self.passes} monitor passes\n\n")
+
+        if self.mode == "cprofile":
+            data_path = base.with_suffix(".prof")
+            self.profile.dump_stats(str(data_path))
+            pstats.Stats(self.profile, stream=summary).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+        elif self.mode == "sample":
+            data_path = base.with_suffix(".folded")
+            data_path.write_text("".join(f"{stack} {count}\n" for stack, count in self.samples.items()))
+            # Self time per function = samples where it was the innermost frame
+            leaf_counts = {}
+            for stack, count in self.samples.items():
+                leaf = stack.rsplit(";", 1)[-1]
+                leaf_counts[leaf] = leaf_counts.get(leaf, 0) + count
+            total = sum(leaf_counts.values()) or 1
+            for leaf, count in sorted(leaf_counts.items(), key=lambda kv: -kv[1])[:PROFILE_TOP_N]:
+                summary.write(f"{count:8d} {100.0 * count / total:6.1f}%  {leaf}\n")
+        else:
+            data_path = base.with_suffix(".tracemalloc")
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            snapshot.dump(str(data_path))
+            for stat in snapshot.statistics("lineno")[:PROFILE_TOP_N]:
+                summary.write(f"{stat}\n")
 
-def monitor_loop():
-    prev_locks = {}
-    debug_log = Path.home() / "droplyx_timing.log"
+        summary_path = Path(f"{base}-top.txt")
+        summary_path.write_text(summary.getvalue())
+        notify("DropLyx Profiling", f"Profile written to:\n{data_path}\n{summary_path.name}")
 
-    while state["running"]:
-        loop_start = time.time()
-        time.sleep(POLL_INTERVAL)
-
-        detect_start = time.time()
-        open_files = get_lyx_open_files()
-        detect_time = time.time() - detect_start
-
-        lock_start = time.time()
-        for f in open_files:
-            if f not in state["my_locks"]:
-                create_lock(f)
-
-        for f in list(state["my_locks"]):
-            if f not in open_files:
-                remove_lock(f)
-        lock_time = time.time() - lock_start
-
-        total_time = time.time() - loop_start
-
-        # Log timing every 10 loops
-        if int(time.time()) % 10 < 1:
-            with open(debug_log, 'a') as f:
-                f.write(f"[{datetime.now().strftime('%H:%M:%S')}] Loop: {total_time:.2f}s (detect: {detect_time:.2f}s, locks: {lock_time:.2f}s) - Files: {len(open_files)}\n")
-
-        state["locked_files"] = scan_all_locks()
-
-        for f, user in state["locked_files"].items():
-            if f not in prev_locks and f not in state["my_locks"]:
-                notify("LyX Sync", f"{Path(f).name} locked by {user}")
-
-        for f in prev_locks:
-            if f not in state["locked_files"] and f not in state["my_locks"]:
-                notify("LyX Sync", f"{Path(f).name} unlocked")
-
-        # Check for remote changes on files we're editing
-        for filepath in list(state["my_locks"]):
-            baseline_path = Path(f"{filepath}{BASELINE_SUFFIX}")
-            if baseline_path.exists() and Path(filepath).exists():
-                # Check if file changed on disk
-                current_hash = compute_file_hash(filepath)
-                last_hash = state["file_hashes"].get(filepath)
-
-                if current_hash and last_hash and current_hash != last_hash:
-                    # File changed on disk while we're editing!
-                    # This means someone else edited it and Dropbox synced it
-
-                    # Save the remote version for merging later
-                    remote_backup = Path(f"{filepath}.remote_version")
-                    try:
-                        shutil.copy2(filepath, remote_backup)
-                        state["pending_merges"][filepath] = str(remote_backup)
 
-                        notify("LyX Sync - Remote Changes!",
-                               f"{Path(filepath).name} was modified by another user.\n"
-                               f"Changes will be merged when you close the file.")
+def start_profiling(mode, passes=PROFILE_PASSES):
+    """Profile the next `passes` monitor passes (ignored if a session is already running)"""
+    if state["profiler"] is None:
+        state["profiler"] = ProfileSession(mode, passes)
+        request_menu_update()
 
-                        # Update the hash
-                        state["file_hashes"][filepath] = current_hash
 
-                    except Exception as e:
-                        notify("LyX Sync - Merge Error",
-                               f"Could not prepare merge for {Path(filepath).name}:\n{str(e)}")
+class TraceRecorder:
+    """
+    Record what the monitor passes observe (open files, the folder scan, lock owners,
+    signatures, hashes, the clock) to a gzip'd JSON-lines trace, one line per pass.
+    Background work a pass starts (see run_in_background) records into that pass, whose
+    line is written once the work is done, so a replay sees it where it runs inline.
+    A value equal to the previous one for the same observation is stored as [kind, key].
+    """
 
-        # Check for file saves (merge-on-save feature)
-        if state.get("merge_on_save", False):
-            for filepath in list(state["my_locks"]):
-                if Path(filepath).exists():
-                    try:
-                        current_mtime = Path(filepath).stat().st_mtime
-                        last_mtime = state["file_mtimes"].get(filepath)
+    replaying = False
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.file = gzip.open(self.path, "wt", encoding="utf-8")
+        self.lock = threading.Lock()
+        self.local = threading.local()  # .buffer: pass a background job records into
+        self.current = self.new_pass()
+        self.pending = deque()  # Finished passes waiting for their background jobs
+        self.last = {}  # {(kind, key): last encoded value written}
+        self.passes = 0
+        header = {"version": TRACE_VERSION, "user": get_username(), "watch_dirs": get_watch_dirs(),
+                  "settle_seconds": state["settle_seconds"], "merge_on_save": state["merge_on_save"]}
+        self.file.write(json.dumps(header) + "\n")
+
+    @staticmethod
+    def new_pass():
+        return {"events": [], "jobs": 0, "ended": False}
+
+    def record(self, kind, key, value):
+        encode = TRACE_CODECS.get(kind, (None, None))[0]
+        encoded = encode(value) if encode and value is not None else value
+        with self.lock:
+            buffer = getattr(self.local, "buffer", None) or self.current
+            buffer["events"].append((kind, key, encoded))
+
+    def track(self, func):
+        """Wrap background work started by the current pass so it records into that pass"""
+        with self.lock:
+            buffer = self.current
+            buffer["jobs"] += 1
+
+        def tracked(*args):
+            self.local.buffer = buffer
+            try:
+                return func(*args)
+            finally:
+                self.local.buffer = None
+                with self.lock:
+                    buffer["jobs"] -= 1
+                    self._flush()
+        return tracked
+
+    def end_pass(self):
+        with self.lock:
+            self.current["ended"] = True
+            self.pending.append(self.current)
+            self.current = self.new_pass()
+            self._flush()
+
+    def _flush(self, force=False):
+        """Write the finished passes in order (call with self.lock held)"""
+        while self.pending and (force or self.pending[0]["jobs"] == 0):
+            events = []
+            for kind, key, encoded in self.pending.popleft()["events"]:
+                if self.last.get((kind, key), self) == encoded:
+                    events.append([kind, key])
+                else:
+                    self.last[(kind, key)] = encoded
+                    events.append([kind, key, encoded])
+            if self.file is not None:
+                self.file.write(json.dumps(events, separators=(",", ":")) + "\n")
+                self.file.flush()
+                self.passes += 1
+
+    def close(self):
+        with self.lock:
+            self._flush(force=True)
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class TraceReplayer:
+    """
+    Feed a recorded trace back through monitor_iteration. Observations come from the
+    trace and the clock is the recorded one; locks, baselines, merges and
+    notifications are dry-run, so nothing on disk is touched.
+    """
 
-                        if last_mtime is not None and current_mtime > last_mtime:
-                            # File was saved (modification time changed)
-                            # Check if there are pending remote changes to merge
-                            if filepath in state["pending_merges"]:
-                                # Perform merge on save
-                                perform_merge_on_save(filepath)
+    replaying = True
+
+    def __init__(self, path):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            self.header = json.loads(f.readline())
+            self.passes = [json.loads(line) for line in f if line.strip()]
+        if self.header.get("version") != TRACE_VERSION:
+            raise ValueError(f"Unsupported trace version: {self.header.get('version')}")
+        self.queues = {}  # {(kind, key): deque of values for the current pass}
+        self.last = {}
+        self.now = None
+        self.missing = 0  # Observations the code asked for that the trace doesn't have
+        self.notifications = []  # [(virtual time, title, message)]
+
+    def load_pass(self, events):
+        self.queues = {}
+        for event in events:
+            kind, key = event[0], event[1]
+            if len(event) > 2:
+                decode = TRACE_CODECS.get(kind, (None, None))[1]
+                self.last[(kind, key)] = decode(event[2]) if decode and event[2] is not None else event[2]
+            self.queues.setdefault((kind, key), deque()).append(self.last[(kind, key)])
+            if kind == "clock":
+                self.now = self.last[(kind, key)]
+
+    def recorded(self, kind, key):
+        try:
+            return self.queues[(kind, key)].popleft()
+        except (KeyError, IndexError):
+            self.missing += 1
+            default = TRACE_DEFAULTS.get(kind)
+            return default() if callable(default) else default
 
-                            # Update the modification time
-                            state["file_mtimes"][filepath] = current_mtime
+    def end_pass(self):
+        pass
 
-                    except Exception as e:
-                        pass  # Ignore errors in save detection
+    def close(self):
+        pass
 
-        # Check for Dropbox conflict files in watched directories
-        for watch_dir in state.get("watch_dirs", []):
-            try:
-                for lyx_file in Path(watch_dir).rglob("*.lyx"):
-                    if is_dropbox_conflict_file(str(lyx_file)):
-                        # Check if we already processed this conflict
-                        conflict_key = f"{lyx_file}:{lyx_file.stat().st_mtime}"
-                        if conflict_key not in state["processed_conflicts"]:
-                            state["processed_conflicts"].add(conflict_key)
-                            # Handle the conflict in a separate thread to avoid blocking
-                            threading.Thread(
-                                target=handle_dropbox_conflict,
-                                args=(str(lyx_file),),
-                                daemon=True
-                            ).start()
-            except Exception as e:
-                pass  # Ignore errors in conflict detection
 
-        # Clean up old processed conflicts (keep only recent ones)
-        if len(state["processed_conflicts"]) > 100:
-            state["processed_conflicts"] = set(list(state["processed_conflicts"])[-50:])
+# Observations that aren't plain JSON: kind -> (encode, decode)
+TRACE_CODECS = {
+    "scan": (TreeScan.to_json, TreeScan.from_json),
+    "signature": (list, tuple),
+}
+# Returned when a replayed pass asks for something the trace doesn't have
+TRACE_DEFAULTS = {
+    "open_files": list,
+    "graph": list,
+    "scan": TreeScan,
+    "clock": time.time,
+    "lock_exists": False,
+    "baseline_exists": False,
+    "temp_sibling": False,
+    "document_free": True,
+}
+
+
+def replaying():
+    """Whether a trace is being replayed (side effects are dry-run)"""
+    trace = state["trace"]
+    return trace is not None and trace.replaying
+
 
-        prev_locks = dict(state["locked_files"])
+def observe(kind, key, func, *args):
+    """
+    Return func(*args), recording it in the active trace. While replaying,
+    return the recorded value instead of calling func.
+    """
+    trace = state["trace"]
+    if trace is None:
+        return func(*args)
+    if trace.replaying:
+        return trace.recorded(kind, key)
+    value = func(*args)
+    trace.record(kind, key, value)
+    return value
+
+
+def run_in_background(func, *args):
+    """
+    Submit work to the background pool. While recording a trace the work records into the
+    current pass; while replaying it runs inline so replays are deterministic.
+    """
+    trace = state["trace"]
+    if trace is not None:
+        if trace.replaying:
+            return func(*args)
+        func = trace.track(func)
+    return background_pool.submit(func, *args)
+
+
+def run_monitor_pass():
+    """One monitor pass, closed off as one line of the trace being recorded"""
+    try:
+        monitor_iteration()
+    finally:
+        trace = state["trace"]
+        if trace is not None:
+            trace.end_pass()
+
+
+def replay_trace(path, profiler=None):
+    """Run every pass of a recorded trace through the monitor logic and report the timings"""
+    replayer = TraceReplayer(path)
+    header = replayer.header
+    state["trace"] = replayer
+    state["watch_dirs"] = header.get("watch_dirs", [])
+    state["settle_seconds"] = header.get("settle_seconds", SETTLE_SECONDS)
+    state["merge_on_save"] = header.get("merge_on_save", False)
+    state["profiler"] = profiler
+    processed_conflicts.clear()
+
+    durations = []
+    for events in replayer.passes:
+        replayer.load_pass(events)
+        start = time.perf_counter()
+        if profiler is not None and state["profiler"] is profiler:
+            profiler.run(monitor_iteration)
+        else:
+            monitor_iteration()
+        durations.append((time.perf_counter() - start, replayer.now))
+    state["trace"] = None
+
+    print(f"Replayed {len(durations)} passes recorded by {header.get('user')} "
+          f"({len(header.get('watch_dirs', []))} folder(s))")
+    if durations:
+        times = sorted(d for d, _ in durations)
+        start_time = next((t for _, t in durations if t is not None), None)
+        print(f"  pass time: total {sum(times):.3f}s, median {times[len(times) // 2] * 1000:.1f}ms, "
+              f"max {times[-1] * 1000:.1f}ms")
+        for duration, now in sorted(durations, key=lambda d: -d[0])[:5]:
+            offset = f"+{now - start_time:.1f}s" if now is not None and start_time is not None else "?"
+            print(f"  slow pass at {offset}: {duration * 1000:.1f}ms")
+    if replayer.missing:
+        print(f"  {replayer.missing} observation(s) missing from the trace (code and trace diverged)")
+    for now, title, message in replayer.notifications:
+        offset = f"+{now - start_time:.1f}s" if now is not None and durations and start_time is not None else "?"
+        print(f"  [{offset}] {title}: {' / '.join(message.splitlines())}")
+    return durations
+
+
+async def wait_for_wakeup(timeout):
+    """Sleep until woken via wake_core() or until `timeout` seconds have passed"""
+    try:
+        await asyncio.wait_for(state["wakeup"].wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    state["wakeup"].clear()
+
+
+async def monitor_task():
+    loop = asyncio.get_running_loop()
+    while state["running"]:
+        await wait_for_wakeup(POLL_INTERVAL)
+        if not state["running"]:
+            break
+        profiler = state["profiler"]
+        if profiler is None:
+            await loop.run_in_executor(scan_pool, run_monitor_pass)
+        else:
+            await loop.run_in_executor(scan_pool, profiler.run, run_monitor_pass)
+            if profiler.remaining <= 0:
+                request_menu_update()
         update_tray()
 
 
+async def menu_task():
+    while state["running"]:
+        await state["menu_event"].wait()
+        state["menu_event"].clear()
+        if state["running"] and state["icon"]:
+            state["icon"].menu = build_menu()
+
+
+def run_core():
+    """Run the asyncio core (monitor and menu tasks) until stop_core() is called"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    state["wakeup"] = asyncio.Event()
+    state["menu_event"] = asyncio.Event()
+    state["loop"] = loop
+
+    async def core():
+        await asyncio.gather(monitor_task(), menu_task())
+
+    try:
+        loop.run_until_complete(core())
+    finally:
+        state["loop"] = None
+        loop.close()
+
+
+def call_in_core(callback, *args):
+    """Schedule `callback` on the core event loop from any thread"""
+    loop = state["loop"]
+    if loop is None or loop.is_closed():
+        return False
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+        return True
+    except RuntimeError:
+        return False
+
+
+def wake_core():
+    """Run the next monitor pass now instead of waiting for the poll interval"""
+    call_in_core(lambda: state["wakeup"].set())
+
+
+def request_menu_update():
+    call_in_core(lambda: state["menu_event"].set())
+
+
+def stop_core():
+    state["running"] = False
+    wake_core()
+    request_menu_update()
+
+
 def on_status(icon, item):
-    parts = [f"Watching {len(state['watch_dirs'])} folder(s)"]
-    if state["my_locks"]:
-        parts.append("You: " + ", ".join(Path(f).name for f in state["my_locks"]))
-    others = {k: v for k, v in state["locked_files"].items() if k not in state["my_locks"]}
+    parts = [f"Watching {len(get_watch_dirs())} folder(s)"]
+    mine, others = get_lock_status()
+    with state_lock:
+        graph_children = state["graph_children"]
+    if mine:
+        # Chapters locked because their master is open are shown with the master
+        names = [f"{Path(f).name} (in {Path(graph_children[f]).name})" if f in graph_children else Path(f).name
+                 for f in mine]
+        parts.append("You: " + ", ".join(names))
     if others:
         parts.append("Others: " + ", ".join(f"{Path(k).name} ({v})" for k, v in others.items()))
     if len(parts) == 1:
         parts.append("No files open")
+    skipped_dirs, skipped_files = state["scan_skipped"]
+    if skipped_dirs or skipped_files:
+        parts.append(f"Ignored: {skipped_dirs} folder(s), {skipped_files} file(s)")
     notify("LyX Sync Status", "\n".join(parts))
 
 
@@ -914,26 +2879,32 @@ def add_folder_prompt():
         except:
             path = input("Enter path to watch: ").strip().strip('"').strip("'")
 
-    if path and Path(path).exists() and path not in state["watch_dirs"]:
-        state["watch_dirs"].append(path)
+    with state_lock:
+        added = bool(path) and Path(path).exists() and path not in state["watch_dirs"]
+        if added:
+            state["watch_dirs"].append(path)
+    if added:
         save_config()
-        state["menu_needs_update"] = True
+        request_menu_update()
+        wake_core()
         notify("LyX Sync", f"Now watching: {path}")
-    elif path and path in state["watch_dirs"]:
+    elif path and path in get_watch_dirs():
         notify("LyX Sync", "Already watching this folder")
 
 
 def on_add_folder(icon, item):
-    t = threading.Thread(target=add_folder_prompt, daemon=True)
-    t.start()
+    background_pool.submit(add_folder_prompt)
 
 
 def make_remove_callback(path):
     def on_remove(icon, item):
-        if path in state["watch_dirs"]:
-            state["watch_dirs"].remove(path)
+        with state_lock:
+            removed = path in state["watch_dirs"]
+            if removed:
+                state["watch_dirs"].remove(path)
+        if removed:
             save_config()
-            state["menu_needs_update"] = True
+            request_menu_update()
             notify("LyX Sync", f"Removed: {path}")
     return on_remove
 
@@ -944,13 +2915,24 @@ def on_toggle_merge_on_save(icon, item):
     save_config()
     status = "enabled" if state["merge_on_save"] else "disabled"
     notify("Merge on Save", f"Merge on save is now {status}")
-    state["menu_needs_update"] = True
+    request_menu_update()
+
+
+def make_profile_callback(mode):
+    def on_profile(icon, item):
+        start_profiling(mode)
+        notify("DropLyx Profiling", f"Profiling the next {PROFILE_PASSES} passes ({mode})")
+    return on_profile
 
 
 def on_quit(icon, item):
-    for f in list(state["my_locks"]):
+    for f in get_my_locks():
         remove_lock(f)
-    state["running"] = False
+    stop_core()
+    if state["save_watcher"]:
+        state["save_watcher"].stop()
+    if state["trace"] is not None:
+        state["trace"].close()
     icon.stop()
 
 
@@ -960,9 +2942,10 @@ def build_menu():
         pystray.MenuItem("Add folder...", on_add_folder),
         pystray.Menu.SEPARATOR,
     ]
-    if state["watch_dirs"]:
+    watch_dirs = get_watch_dirs()
+    if watch_dirs:
         items.append(pystray.MenuItem("Watching:", None, enabled=False))
-        for d in state["watch_dirs"]:
+        for d in watch_dirs:
             short = str(d) if len(str(d)) < 45 else "..." + str(d)[-42:]
             items.append(pystray.MenuItem(f"  x {short}", make_remove_callback(d)))
         items.append(pystray.Menu.SEPARATOR)
@@ -973,19 +2956,16 @@ def build_menu():
         on_toggle_merge_on_save,
         checked=lambda _: state.get("merge_on_save", False)
     ))
+    items.append(pystray.MenuItem("Profile", pystray.Menu(
+        pystray.MenuItem(f"CPU (cProfile, {PROFILE_PASSES} passes)", make_profile_callback("cprofile")),
+        pystray.MenuItem(f"CPU (sampling, {PROFILE_PASSES} passes)", make_profile_callback("sample")),
+        pystray.MenuItem(f"Memory (tracemalloc, {PROFILE_PASSES} passes)", make_profile_callback("tracemalloc")),
+    ), enabled=lambda _: state["profiler"] is None))
     items.append(pystray.Menu.SEPARATOR)
     items.append(pystray.MenuItem("Quit", on_quit))
     return tuple(items)
 
 
-def menu_updater():
-    while state["running"]:
-        time.sleep(1)
-        if state["menu_needs_update"] and state["icon"]:
-            state["icon"].menu = build_menu()
-            state["menu_needs_update"] = False
-
-
 def prompt_initial_path():
     if sys.platform == "win32":
         import tkinter as tk
@@ -1022,11 +3002,34 @@ def prompt_initial_path():
     return path
 
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Collaborative LyX editing via Dropbox")
+    parser.add_argument("dirs", nargs="*", help="Folders to watch (default: from config)")
+    parser.add_argument("--profile", choices=PROFILE_MODES,
+                        help=f"Profile the first monitor passes and write the results to {PROFILE_DIR}")
+    parser.add_argument("--profile-passes", type=int, default=PROFILE_PASSES,
+                        help="Number of monitor passes to profile")
+    parser.add_argument("--record-trace", metavar="FILE",
+                        help="Record what each monitor pass observes to a trace file (.jsonl.gz)")
+    parser.add_argument("--replay-trace", metavar="FILE",
+                        help="Replay a recorded trace offline (no tray, nothing on disk changed) and report pass timings")
+    return parser.parse_args(argv)
+
+
 def main():
+    args = parse_args()
+    if args.replay_trace:
+        profiler = ProfileSession(args.profile, args.profile_passes) if args.profile else None
+        replay_trace(args.replay_trace, profiler)
+        if profiler is not None and state["profiler"] is profiler:
+            profiler.finish()
+        return
+    if pystray is None:
+        sys.exit("DropLyx needs a system tray (pystray could not be loaded)")
     dirs, merge_on_save = load_config()
 
-    if len(sys.argv) > 1:
-        dirs = [p for p in sys.argv[1:] if Path(p).exists()]
+    if args.dirs:
+        dirs = [p for p in args.dirs if Path(p).exists()]
     elif not dirs:
         path = prompt_initial_path()
         dirs = [path]
@@ -1034,12 +3037,22 @@ def main():
     state["watch_dirs"] = dirs
     state["merge_on_save"] = merge_on_save
     save_config()
+    clear_presence()
+    load_processed_conflicts()
+    if args.profile:
+        state["profiler"] = ProfileSession(args.profile, args.profile_passes)
+    if args.record_trace:
+        state["trace"] = TraceRecorder(args.record_trace)
 
     # Show initial notification
     notify("LyX Sync Started", f"Monitoring {len(dirs)} folder(s)")
 
-    threading.Thread(target=monitor_loop, daemon=True).start()
-    threading.Thread(target=menu_updater, daemon=True).start()
+    # Merge-on-save is driven by save events; the merge itself runs in the background pool
+    state["save_watcher"] = SaveWatcher(lambda path: background_pool.submit(on_document_saved, path))
+    state["save_watcher"].start()
+
+    # The tray icon needs the main thread, so the asyncio core runs in its own thread
+    threading.Thread(target=run_core, daemon=True).start()
 
     icon = pystray.Icon("DropLyx", create_icon("lightblue"), "DropLyx", menu=build_menu())
     state["icon"] = icon
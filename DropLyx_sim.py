@@ -0,0 +1,507 @@
+"""
+DropLyx multi-replica sync simulator.
+
+Mirrors two or more replica folders through a simulated Dropbox server with a
+configurable propagation delay. Concurrent writes produce
+"name (<user>'s conflicted copy YYYY-MM-DD).lyx" files like Dropbox does.
+One headless DropLyx monitor runs per replica (as a subprocess, so each has its
+own state, user name and home folder), and scripted LyX sessions open, edit,
+save and close a shared document on every replica.
+
+The report covers lock propagation latency, merge counts, conflict rates and
+lost updates (saved edits missing from the converged document).
+
+Usage:
+    python DropLyx_sim.py --replicas 2 --delay 2 --edits 3
+    python DropLyx_sim.py --replicas 3 --delay 1 --same-paragraph --json report.json
+"""
+import os
+import sys
+import time
+import json
+import signal
+import shutil
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from datetime import datetime
+
+DOCUMENT = "shared.lyx"
+DROPBOX_CACHE_DIR = ".dropbox.cache"
+SYNC_TICK = 0.1  # Seconds between simulated Dropbox scans
+SIM_DEVICE = "sim"  # Device id of every replica, so presence manifests are "<user>@sim.json"
+
+# Notification titles emitted by DropLyx, grouped for the report
+MERGE_SUCCESS_TITLES = ("LyX Sync - Merge Successful", "Merge on Save - Success", "Dropbox Conflict Auto-Merged")
+MERGE_CONFLICT_TITLES = ("LyX Sync - Merge Conflicts", "Merge on Save - Conflicts Detected",
+                         "Dropbox Conflict - Manual Resolution Needed")
+REMOTE_CHANGE_TITLES = ("LyX Sync - Remote Changes!",)
+
+
+def file_hash(content):
+    return None if content is None else hashlib.sha256(content).hexdigest()
+
+
+def conflicted_copy_name(rel, user, when):
+    """Dropbox's name for a conflicting upload, e.g. "doc (bob's conflicted copy 2024-01-15).lyx" """
+    path = Path(rel)
+    return str(path.with_name(f"{path.stem} ({user}'s conflicted copy {when:%Y-%m-%d}){path.suffix}"))
+
+
+class SimulatedDropbox:
+    """
+    Central server plus one sync client per replica folder.
+    Local changes are uploaded delay/2 after they are seen and downloaded by the
+    other replicas delay/2 after the server accepted them. An upload whose parent
+    revision is no longer the server's head becomes a conflicted copy, and the
+    replica gets the server version back.
+    """
+
+    def __init__(self, replicas, users, delay):
+        self.replicas = [Path(r) for r in replicas]
+        self.users = users
+        self.delay = delay
+        self.server = {}  # {rel: (content or None if deleted, rev, accepted_at)}
+        self.synced_rev = [{} for _ in replicas]  # {rel: server rev the replica last saw}
+        self.synced_hash = [{} for _ in replicas]  # {rel: content hash at that rev}
+        self.pending_uploads = [{} for _ in replicas]  # {rel: due time}
+        self.stat_cache = [{} for _ in replicas]  # {rel: ((size, mtime_ns), hash)}
+        self.deliveries = []  # (time, replica, rel, deleted)
+        self.local_changes = []  # (time, replica, rel, deleted) as first seen by the client
+        self.uploads = 0
+        self.conflicted_copies = []  # (time, replica, conflicted rel)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def scan(self, i):
+        """Return {rel: hash} for the files currently in replica i"""
+        root = self.replicas[i]
+        current = {}
+        cache = self.stat_cache[i]
+        for dirpath, dirnames, filenames in os.walk(root):
+            if DROPBOX_CACHE_DIR in dirnames:
+                dirnames.remove(DROPBOX_CACHE_DIR)
+            for name in filenames:
+                path = Path(dirpath) / name
+                rel = str(path.relative_to(root))
+                try:
+                    st = path.stat()
+                except OSError:
+                    continue
+                signature = (st.st_size, st.st_mtime_ns)
+                cached = cache.get(rel)
+                if cached and cached[0] == signature:
+                    current[rel] = cached[1]
+                    continue
+                try:
+                    digest = file_hash(path.read_bytes())
+                except OSError:
+                    continue
+                cache[rel] = (signature, digest)
+                current[rel] = digest
+        return current
+
+    def upload(self, i, rel, now):
+        path = self.replicas[i] / rel
+        try:
+            content = path.read_bytes()
+        except OSError:
+            content = None
+        parent = self.synced_rev[i].get(rel, 0)
+        head = self.server.get(rel, (None, 0, 0))[1]
+        self.uploads += 1
+
+        if head == parent:
+            self.server[rel] = (content, head + 1, now)
+            self.synced_rev[i][rel] = head + 1
+            self.synced_hash[i][rel] = file_hash(content)
+            return
+
+        # Someone else got there first
+        if content is None:
+            # Local delete of a file changed remotely - Dropbox keeps the remote version
+            self.synced_rev[i][rel] = 0
+            self.synced_hash[i][rel] = None
+            return
+        copy_rel = conflicted_copy_name(rel, self.users[i], datetime.now())
+        copy_path = self.replicas[i] / copy_rel
+        os.replace(path, copy_path)
+        self.server[copy_rel] = (content, 1, now)
+        self.synced_rev[i][copy_rel] = 1
+        self.synced_hash[i][copy_rel] = file_hash(content)
+        self.conflicted_copies.append((now, i, copy_rel))
+        # The original name gets the server's version on the next download
+        self.synced_rev[i][rel] = 0
+        self.synced_hash[i][rel] = None
+
+    def download(self, i, rel, now):
+        content, rev, _ = self.server[rel]
+        path = self.replicas[i] / rel
+        if content is None:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+        else:
+            # Stage in .dropbox.cache and move into place, like the real client
+            staging = self.replicas[i] / DROPBOX_CACHE_DIR
+            staging.mkdir(exist_ok=True)
+            tmp = staging / f"{os.getpid()}-{rev}-{path.name}"
+            tmp.write_bytes(content)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp, path)
+        self.synced_rev[i][rel] = rev
+        self.synced_hash[i][rel] = file_hash(content)
+        self.deliveries.append((now, i, rel, content is None))
+
+    def tick(self):
+        now = time.time()
+        with self.lock:
+            for i in range(len(self.replicas)):
+                current = self.scan(i)
+                pending = self.pending_uploads[i]
+                for rel in set(current) | set(self.synced_hash[i]):
+                    if current.get(rel) != self.synced_hash[i].get(rel):
+                        if rel not in pending:
+                            pending[rel] = now + self.delay / 2
+                            self.local_changes.append((now, i, rel, rel not in current))
+                    else:
+                        pending.pop(rel, None)
+                for rel, due in list(pending.items()):
+                    if now >= due:
+                        pending.pop(rel)
+                        self.upload(i, rel, now)
+
+                for rel, (_, rev, accepted_at) in list(self.server.items()):
+                    if rev <= self.synced_rev[i].get(rel, 0) or now < accepted_at + self.delay / 2:
+                        continue
+                    if rel in pending:
+                        continue  # Unsynced local change - the upload will sort it out
+                    self.download(i, rel, now)
+
+    def run(self):
+        while not self.stopped.wait(SYNC_TICK):
+            self.tick()
+
+    def is_idle(self):
+        with self.lock:
+            if any(self.pending_uploads):
+                return False
+            for i in range(len(self.replicas)):
+                for rel, (_, rev, _) in self.server.items():
+                    if self.synced_rev[i].get(rel, 0) < rev:
+                        return False
+            return True
+
+
+class LyXSession:
+    """
+    Scripted LyX user on one replica. The buffer is read on open and written back
+    on save, so - like the real editor - it does not see remote changes in between.
+    """
+
+    def __init__(self, replica, user, open_list):
+        self.replica = Path(replica)
+        self.user = user
+        self.open_list = Path(open_list)
+        self.path = self.replica / DOCUMENT
+        self.buffer = None
+        self.saved_markers = []
+        self.pending_marker = None
+        self.opened_at = None
+
+    def open(self):
+        self.buffer = self.path.read_text().splitlines(keepends=True)
+        self.open_list.write_text(f"{self.path}\n")
+        self.opened_at = time.time()
+
+    def edit(self, line_no, marker):
+        self.buffer[line_no] = self.buffer[line_no].rstrip("\n") + f" {marker}\n"
+        self.pending_marker = marker
+
+    def save(self):
+        # LyX writes a temp file and renames it over the document
+        tmp = self.path.with_name(f".{self.path.name}.{self.user}.tmp-save")
+        tmp.write_text("".join(self.buffer))
+        os.replace(tmp, self.path)
+        self.saved_markers.append(self.pending_marker)
+
+    def close(self):
+        self.open_list.write_text("")
+        self.buffer = None
+
+
+def make_document(paragraphs):
+    lines = ["#LyX 2.3 created this file. For more info see http://www.lyx.org/\n",
+             "\\lyxformat 544\n", "\\begin_document\n", "\\begin_body\n"]
+    for n in range(paragraphs):
+        lines.append("\\begin_layout Standard\n")
+        lines.append(f"Paragraph {n} of the shared document.\n")
+        lines.append("\\end_layout\n")
+    lines += ["\\end_body\n", "\\end_document\n"]
+    return "".join(lines)
+
+
+def paragraph_line(n):
+    """Line index of paragraph n's text in make_document()"""
+    return 4 + 3 * n + 1
+
+
+def build_script(sessions, edits, stagger, edit_interval, hold, same_paragraph):
+    """Return [(offset seconds, action, session index, args)] for all users"""
+    script = []
+    for i, _ in enumerate(sessions):
+        t = i * stagger
+        script.append((t, "open", i, ()))
+        for k in range(edits):
+            t += edit_interval
+            paragraph = k if same_paragraph else i * edits + k
+            script.append((t, "edit", i, (paragraph_line(paragraph), f"EDIT-{sessions[i].user}-{k}")))
+            script.append((t, "save", i, ()))
+        script.append((t + hold, "close", i, ()))
+    return sorted(script, key=lambda step: step[0])
+
+
+def start_worker(replica, user, home, open_list, events, merge_on_save, settle, presence_manifest):
+    env = dict(os.environ, HOME=str(home), USER=user, USERNAME=user)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [str(Path(__file__).parent), env.get("PYTHONPATH")]))
+    cmd = [sys.executable, __file__, "--worker",
+           "--replica", str(replica), "--open-list", str(open_list),
+           "--events", str(events), "--settle", str(settle)]
+    if merge_on_save:
+        cmd.append("--merge-on-save")
+    if presence_manifest:
+        cmd.append("--presence-manifest")
+    return subprocess.Popen(cmd, env=env)
+
+
+def run_worker(args):
+    """Headless DropLyx monitor for one replica (runs in its own process)"""
+    import DropLyx
+
+    events = open(args.events, "a")
+    events_lock = threading.Lock()
+    open_list = Path(args.open_list)
+
+    def notify(title, message):
+        with events_lock:
+            events.write(json.dumps({"time": time.time(), "title": title, "message": message}) + "\n")
+            events.flush()
+
+    def get_lyx_open_files():
+        try:
+            return [line for line in open_list.read_text().splitlines() if line]
+        except OSError:
+            return []
+
+    DropLyx.notify = notify
+    DropLyx.get_lyx_open_files = get_lyx_open_files
+    DropLyx.state["watch_dirs"] = [args.replica]
+    DropLyx.state["merge_on_save"] = args.merge_on_save
+    DropLyx.state["presence_manifest"] = args.presence_manifest
+    DropLyx.state["device_id"] = SIM_DEVICE
+    DropLyx.state["settle_seconds"] = args.settle
+    DropLyx.state["save_watcher"] = DropLyx.SaveWatcher(
+        lambda path: DropLyx.background_pool.submit(DropLyx.on_document_saved, path))
+    DropLyx.state["save_watcher"].start()
+
+    def on_term(signum, frame):
+        DropLyx.stop_core()
+    signal.signal(signal.SIGTERM, on_term)
+    DropLyx.run_core()
+
+
+def read_events(path):
+    try:
+        return [json.loads(line) for line in Path(path).read_text().splitlines() if line]
+    except OSError:
+        return []
+
+
+def build_report(dropbox, sessions, events_files, lock_opened, lock_items):
+    replicas = len(sessions)
+    report = {"replicas": replicas, "delay": dropbox.delay}
+
+    # Lock propagation: open in replica i -> lock created locally -> lock delivered to j.
+    # lock_items[i] is the file announcing replica i's lock (.lock file or presence manifest)
+    detect, propagate = [], []
+    for i, opened_at in lock_opened:
+        lock_rel = lock_items[i]
+        created = [t for t, r, rel, deleted in dropbox.local_changes
+                   if r == i and rel == lock_rel and not deleted and t >= opened_at]
+        if created:
+            detect.append(created[0] - opened_at)
+        for j in range(replicas):
+            if j == i:
+                continue
+            delivered = [t for t, r, rel, deleted in dropbox.deliveries
+                         if r == j and rel == lock_rel and not deleted and t >= opened_at]
+            if delivered:
+                propagate.append(delivered[0] - opened_at)
+
+    def summary(values):
+        if not values:
+            return None
+        values = sorted(values)
+        return {"count": len(values), "min": round(values[0], 3),
+                "median": round(values[len(values) // 2], 3), "max": round(values[-1], 3)}
+
+    report["lock_detect_latency"] = summary(detect)
+    report["lock_propagation_latency"] = summary(propagate)
+
+    # Merge activity reported by the monitors
+    events = [e for path in events_files for e in read_events(path)]
+    report["remote_changes_detected"] = sum(e["title"] in REMOTE_CHANGE_TITLES for e in events)
+    report["merges"] = sum(e["title"] in MERGE_SUCCESS_TITLES for e in events)
+    report["merge_conflicts"] = sum(e["title"] in MERGE_CONFLICT_TITLES for e in events)
+
+    # Dropbox-level conflicts
+    report["uploads"] = dropbox.uploads
+    report["conflicted_copies"] = len(dropbox.conflicted_copies)
+    report["conflict_rate"] = round(len(dropbox.conflicted_copies) / dropbox.uploads, 4) if dropbox.uploads else 0.0
+
+    # Lost updates: saved edits missing from the final document
+    finals = [(s.replica / DOCUMENT).read_text() if (s.replica / DOCUMENT).exists() else "" for s in sessions]
+    markers = [m for s in sessions for m in s.saved_markers]
+    report["saved_edits"] = len(markers)
+    report["lost_updates"] = sorted({m for m in markers for text in finals if m not in text})
+    report["converged"] = len(set(finals)) == 1
+    return report
+
+
+def print_report(report):
+    print("DropLyx sync simulation")
+    print(f"  replicas: {report['replicas']}, propagation delay: {report['delay']}s")
+    for key in ("lock_detect_latency", "lock_propagation_latency"):
+        value = report[key]
+        text = "n/a" if value is None else f"median {value['median']}s (min {value['min']}s, max {value['max']}s, n={value['count']})"
+        print(f"  {key.replace('_', ' ')}: {text}")
+    print(f"  remote changes detected: {report['remote_changes_detected']}")
+    print(f"  merges: {report['merges']}, merge conflicts: {report['merge_conflicts']}")
+    print(f"  conflicted copies: {report['conflicted_copies']} of {report['uploads']} uploads "
+          f"({100 * report['conflict_rate']:.1f}%)")
+    print(f"  saved edits: {report['saved_edits']}, lost: {len(report['lost_updates'])} "
+          f"{', '.join(report['lost_updates'])}")
+    print(f"  replicas converged: {'yes' if report['converged'] else 'NO'}")
+
+
+def run_simulation(args):
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix="droplyx-sim-"))
+    users = [f"user{i + 1}" for i in range(args.replicas)]
+    paragraphs = max(args.edits * args.replicas, 1) + 2
+    document = make_document(paragraphs)
+
+    replicas, sessions, workers, events_files = [], [], [], []
+    for i, user in enumerate(users):
+        replica = workdir / f"replica{i + 1}"
+        home = workdir / f"home{i + 1}"
+        replica.mkdir(parents=True, exist_ok=True)
+        home.mkdir(parents=True, exist_ok=True)
+        (replica / DOCUMENT).write_text(document)
+        open_list = home / "open_files.txt"
+        open_list.write_text("")
+        events = home / "events.jsonl"
+        replicas.append(replica)
+        sessions.append(LyXSession(replica, user, open_list))
+        events_files.append(events)
+
+    dropbox = SimulatedDropbox(replicas, users, args.delay)
+    # Everyone starts from the same synced document
+    for i in range(len(replicas)):
+        dropbox.synced_hash[i][DOCUMENT] = file_hash(document.encode())
+        dropbox.synced_rev[i][DOCUMENT] = 1
+    dropbox.server[DOCUMENT] = (document.encode(), 1, time.time())
+    sync_thread = threading.Thread(target=dropbox.run, daemon=True)
+    sync_thread.start()
+
+    for i, user in enumerate(users):
+        workers.append(start_worker(replicas[i], user, workdir / f"home{i + 1}",
+                                    sessions[i].open_list, events_files[i],
+                                    args.merge_on_save, args.settle, args.presence_manifest))
+
+    lock_opened = []
+    try:
+        time.sleep(args.startup)
+        script = build_script(sessions, args.edits, args.stagger, args.edit_interval,
+                              args.hold, args.same_paragraph)
+        start = time.time()
+        for offset, action, i, step_args in script:
+            wait = start + offset - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            session = sessions[i]
+            getattr(session, action)(*step_args)
+            if action == "open":
+                lock_opened.append((i, session.opened_at))
+
+        # Let locks, merges and syncs settle
+        deadline = time.time() + args.quiesce
+        while time.time() < deadline:
+            time.sleep(0.5)
+            if time.time() > deadline - args.quiesce / 2 and dropbox.is_idle():
+                break
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            try:
+                worker.wait(5)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+        dropbox.stopped.set()
+        sync_thread.join(2)
+
+    if args.presence_manifest:
+        lock_items = [str(Path(".droplyx-presence") / f"{user}@{SIM_DEVICE}.json") for user in users]
+    else:
+        lock_items = [f"{DOCUMENT}.lock"] * len(users)
+    report = build_report(dropbox, sessions, events_files, lock_opened, lock_items)
+    report["workdir"] = str(workdir)
+    print_report(report)
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2))
+    if not args.keep and not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Simulate Dropbox sync between DropLyx replicas")
+    parser.add_argument("--replicas", type=int, default=2, help="Number of users/replica folders")
+    parser.add_argument("--delay", type=float, default=2.0, help="Propagation delay in seconds")
+    parser.add_argument("--edits", type=int, default=3, help="Edit+save cycles per user")
+    parser.add_argument("--stagger", type=float, default=0.5, help="Seconds between users opening the document")
+    parser.add_argument("--edit-interval", type=float, default=3.0, help="Seconds between a user's saves")
+    parser.add_argument("--hold", type=float, default=3.0, help="Seconds a user keeps the document open after the last save")
+    parser.add_argument("--same-paragraph", action="store_true", help="All users edit the same paragraphs (forces merge conflicts)")
+    parser.add_argument("--merge-on-save", action="store_true", help="Enable merge-on-save in the monitors")
+    parser.add_argument("--presence-manifest", action="store_true",
+                        help="Monitors announce locks in presence manifests instead of .lock files")
+    parser.add_argument("--settle", type=float, default=1.0, help="settle_seconds for the monitors")
+    parser.add_argument("--startup", type=float, default=2.0, help="Seconds to let the monitors start")
+    parser.add_argument("--quiesce", type=float, default=20.0, help="Max seconds to wait for syncs/merges at the end")
+    parser.add_argument("--workdir", help="Folder for replicas (default: a temp folder)")
+    parser.add_argument("--keep", action="store_true", help="Keep the temp folder")
+    parser.add_argument("--json", help="Also write the report as JSON to this file")
+    # Worker mode (internal)
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--replica", help=argparse.SUPPRESS)
+    parser.add_argument("--open-list", help=argparse.SUPPRESS)
+    parser.add_argument("--events", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    if args.worker:
+        run_worker(args)
+    else:
+        report = run_simulation(args)
+        sys.exit(1 if report["lost_updates"] or not report["converged"] else 0)
+
+
+if __name__ == "__main__":
+    main()
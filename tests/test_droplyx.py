@@ -0,0 +1,186 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import DropLyx  # noqa: E402
+
+
+@pytest.mark.parametrize("title, expected", [
+    ("paper.lyx - LyX", ("paper.lyx", None)),
+    ("paper.lyx (~\\Dropbox\\Paper) - LyX", ("paper.lyx", "~\\Dropbox\\Paper")),
+    ("paper.lyx (/home/me/Dropbox/Paper) - LyX", ("paper.lyx", "/home/me/Dropbox/Paper")),
+    ("notes.txt - LyX", None),
+    ("paper.lyx - Firefox", None),
+    ("", None),
+])
+def test_parse_lyx_window_title(title, expected):
+    assert DropLyx.parse_lyx_window_title(title) == expected
+
+
+@pytest.fixture
+def watch_dir(tmp_path):
+    paper = tmp_path / "Dropbox" / "Paper"
+    paper.mkdir(parents=True)
+    (paper / "paper.lyx").write_text("#LyX\n")
+    (tmp_path / "Dropbox" / "other.lyx").write_text("#LyX\n")
+    root = str(tmp_path / "Dropbox")
+    DropLyx.title_cache.clear()
+    DropLyx.lyx_index.roots = None
+    DropLyx.lyx_index.ensure([root])
+    return root
+
+
+def test_resolve_window_title(watch_dir):
+    expected = [str((Path(watch_dir) / "Paper" / "paper.lyx").resolve())]
+    folder = str(Path(watch_dir) / "Paper")
+    assert DropLyx.resolve_window_title("paper.lyx - LyX", [watch_dir]) == expected
+    assert DropLyx.resolve_window_title("paper.lyx (~\\Dropbox\\Paper) - LyX", [watch_dir]) == expected
+    assert DropLyx.resolve_window_title(f"paper.lyx ({folder}) - LyX", [watch_dir]) == expected
+    assert DropLyx.resolve_window_title("missing.lyx - LyX", [watch_dir]) == []
+    assert DropLyx.resolve_window_title("Inbox - Thunderbird", [watch_dir]) == []
+
+
+def test_resolve_window_title_is_cached(watch_dir):
+    titles = [f"chapter{i}.lyx - LyX" for i in range(200)]
+    for title in titles:
+        DropLyx.resolve_window_title(title, [watch_dir])
+    cached = len(DropLyx.title_cache)
+    for title in titles:
+        DropLyx.resolve_window_title(title, [watch_dir])
+    assert len(DropLyx.title_cache) == cached == min(len(titles), DropLyx.TITLE_CACHE_SIZE)
+
+
+@pytest.mark.parametrize("exclude, include, relpath, is_dir, ignored", [
+    (["build/"], [], "build", True, True),
+    (["build/"], [], "build", False, False),  # "dir/" only matches folders
+    (["build/"], [], "paper/build", True, True),  # Unanchored: any depth
+    (["/build"], [], "paper/build", True, False),  # Leading "/" anchors to the watch folder
+    (["paper/build"], [], "paper/build", True, True),
+    (["paper/build"], [], "other/paper/build", True, False),  # A "/" anchors too
+    (["**/figures"], [], "a/b/figures", True, True),
+    (["**/figures"], [], "figures", True, True),
+    (["drafts/**"], [], "drafts/old/x.lyx", False, True),
+    (["*.lyx"], [], "paper/draft.lyx", False, True),
+    (["draft?.lyx"], [], "draft1.lyx", False, True),
+    (["draft?.lyx"], [], "draft10.lyx", False, False),
+    (["draft[0-9].lyx"], [], "draft3.lyx", False, True),
+    (["draft[!0-9].lyx"], [], "draft3.lyx", False, False),
+    (["draft[!0-9].lyx"], [], "draftA.lyx", False, True),
+    (["*.lyx", "!keep.lyx"], [], "keep.lyx", False, False),
+    (["*.lyx"], ["keep.lyx"], "keep.lyx", False, False),
+    (["*.lyx"], ["!keep.lyx"], "keep.lyx", False, False),  # "!" in include still includes
+    (["!keep.lyx", "*.lyx"], [], "keep.lyx", False, True),  # Last match wins
+    (["# comment", ""], [], "# comment", False, False),
+])
+def test_ignore_rules(exclude, include, relpath, is_dir, ignored):
+    assert DropLyx.IgnoreRules(exclude, include).ignored(relpath, is_dir) == ignored
+
+
+@pytest.mark.parametrize("platform, ignored", [("win32", True), ("linux", False)])
+def test_ignore_rules_case(monkeypatch, platform, ignored):
+    monkeypatch.setattr(sys, "platform", platform)
+    assert DropLyx.IgnoreRules(["Build/"]).ignored("build", True) == ignored
+
+
+def test_tree_scanner_prunes_excluded_folders(tmp_path, monkeypatch):
+    (tmp_path / "paper").mkdir()
+    (tmp_path / "paper" / "paper.lyx").write_text("#LyX\n")
+    (tmp_path / "paper" / "paper.lyx.lock").write_text("alice")
+    (tmp_path / "build" / "deep").mkdir(parents=True)
+    (tmp_path / "build" / "deep" / "copy.lyx").write_text("#LyX\n")
+    (tmp_path / "old.lyx").write_text("#LyX\n")
+    scanner = DropLyx.TreeScanner(workers=2)
+    listed = []
+    list_dir = scanner.list_dir
+    monkeypatch.setattr(scanner, "list_dir", lambda folder: listed.append(folder) or list_dir(folder))
+
+    root = str(tmp_path)
+    scan = scanner.scan([root], DropLyx.IgnoreRules(["build/", "/old.lyx"]))
+    assert [path for _, path, _ in scan.lyx_files] == [str(tmp_path / "paper" / "paper.lyx")]
+    assert [path for path, _ in scan.lock_files] == [str(tmp_path / "paper" / "paper.lyx.lock")]
+    assert scan.skipped_dirs == 1
+    assert scan.skipped_files == 1
+    assert sorted(listed) == [root, str(tmp_path / "paper")]
+
+
+@pytest.fixture
+def presence(tmp_path, monkeypatch):
+    """A watch folder in presence-manifest mode, as user bob on device laptop"""
+    root = tmp_path / "Dropbox"
+    root.mkdir()
+    for name in ("paper.lyx", "notes.lyx"):
+        (root / name).write_text("#LyX\n")
+    monkeypatch.setenv("USER", "bob")
+    monkeypatch.setitem(DropLyx.state, "watch_dirs", [str(root)])
+    monkeypatch.setitem(DropLyx.state, "presence_manifest", True)
+    monkeypatch.setitem(DropLyx.state, "device_id", "laptop")
+    monkeypatch.setitem(DropLyx.state, "presence", {})
+    return root
+
+
+def write_manifest(root, name, user, documents):
+    folder = root / DropLyx.PRESENCE_DIR
+    folder.mkdir(exist_ok=True)
+    (folder / name).write_text(DropLyx.json.dumps({"user": user, "documents": documents}))
+
+
+def test_presence_manifest_round_trip(presence):
+    assert DropLyx.update_presence(str(presence / "paper.lyx"), True)
+    manifest = presence / DropLyx.PRESENCE_DIR / "bob@laptop.json"
+    assert DropLyx.json.loads(manifest.read_text())["documents"] == ["paper.lyx"]
+    assert DropLyx.read_presence(str(presence)) == {str(presence / "paper.lyx"): "bob"}
+    assert DropLyx.update_presence(str(presence / "paper.lyx"), False)
+    assert DropLyx.read_presence(str(presence)) == {}
+
+
+def test_held_by_other(presence):
+    write_manifest(presence, "alice@desktop.json", "alice", ["paper.lyx"])
+    write_manifest(presence, "bob@desktop.json", "bob", ["notes.lyx"])
+    assert DropLyx.held_by_other(str(presence / "paper.lyx"))
+    # The same user on another machine holds it too
+    assert DropLyx.held_by_other(str(presence / "notes.lyx"))
+    DropLyx.update_presence(str(presence / "notes.lyx"), False)
+    assert not DropLyx.held_by_other(str(presence / "missing.lyx"))
+
+
+def test_conflicted_manifest_copies(presence):
+    write_manifest(presence, "alice@desktop (conflicted copy 2026-01-01).json", "alice", ["paper.lyx"])
+    write_manifest(presence, "bob@laptop (conflicted copy 2026-01-01).json", "bob", ["notes.lyx"])
+    write_manifest(presence, "bob@laptop.json", "bob", ["notes.lyx"])
+    assert DropLyx.read_presence(str(presence)) == {str(presence / "notes.lyx"): "bob"}
+    DropLyx.clear_presence()
+    assert sorted(p.name for p in (presence / DropLyx.PRESENCE_DIR).iterdir()) == [
+        "alice@desktop (conflicted copy 2026-01-01).json", "bob@laptop.json"]
+    assert DropLyx.read_presence(str(presence)) == {}
+
+
+def test_create_lock_falls_back_to_lock_file(presence, tmp_path, monkeypatch):
+    monkeypatch.setitem(DropLyx.state, "save_watcher", None)
+    outside = tmp_path / "elsewhere" / "chapter.lyx"
+    outside.parent.mkdir()
+    outside.write_text("#LyX\n")
+    inside = presence / "paper.lyx"
+    try:
+        DropLyx.create_lock(str(inside))
+        DropLyx.create_lock(str(outside))
+        assert not Path(f"{inside}.lock").exists()
+        assert Path(f"{outside}.lock").read_text() == "bob"
+    finally:
+        DropLyx.remove_lock(str(inside))
+        DropLyx.remove_lock(str(outside))
+    assert not Path(f"{outside}.lock").exists()
+    assert DropLyx.read_presence(str(presence)) == {}
+
+
+def test_create_lock_falls_back_when_manifest_unwritable(presence, monkeypatch):
+    monkeypatch.setitem(DropLyx.state, "save_watcher", None)
+    (presence / DropLyx.PRESENCE_DIR).write_text("not a folder")
+    document = presence / "notes.lyx"
+    try:
+        DropLyx.create_lock(str(document))
+        assert Path(f"{document}.lock").read_text() == "bob"
+        assert DropLyx.state["presence"].get(str(presence), set()) == set()
+    finally:
+        DropLyx.remove_lock(str(document))
@@ -0,0 +1,93 @@
+import os
+import select
+import sys
+import threading
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import DropLyx  # noqa: E402
+
+
+class FakeLyXServer:
+    """
+    Stand-in for LyX on a pair of FIFOs. Answers the first LYXCMD with
+    reply(function, argument), a "KIND:{client}:{function}:data" template, or not at all for None.
+    """
+
+    def __init__(self, base, reply):
+        self.base = base
+        self.reply = reply
+        self.commands = []
+        os.mkfifo(f"{base}.in")
+        os.mkfifo(f"{base}.out")
+        self.in_fd = os.open(f"{base}.in", os.O_RDONLY | os.O_NONBLOCK)
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        buffer = b""
+        while b"\n" not in buffer:
+            ready, _, _ = select.select([self.in_fd], [], [], 5)
+            if not ready:
+                return
+            buffer += os.read(self.in_fd, 4096)
+        line = buffer.split(b"\n", 1)[0].decode()
+        _, client, function, argument = line.split(":", 3)
+        self.commands.append((function, argument))
+        answer = self.reply(function, argument)
+        if answer is not None:
+            with open(f"{self.base}.out", "w") as out:
+                out.write(answer.format(client=client, function=function) + "\n")
+
+    def close(self):
+        self.thread.join(5)
+        os.close(self.in_fd)
+
+
+fifo_only = pytest.mark.skipif(not hasattr(os, "mkfifo") or sys.platform == "win32",
+                               reason="lyxserver FIFOs are POSIX only")
+
+
+@fifo_only
+def test_lyxserver_info_reply(tmp_path):
+    base = str(tmp_path / "lyxpipe")
+    server = FakeLyXServer(base, lambda function, argument: "INFO:{client}:{function}:/home/me/paper.lyx")
+    try:
+        client = DropLyx.LyXServerClient(base, timeout=2)
+        assert client.send("server-get-filename") == "/home/me/paper.lyx"
+    finally:
+        server.close()
+    assert server.commands == [("server-get-filename", "")]
+
+
+@fifo_only
+def test_lyxserver_error_reply(tmp_path):
+    base = str(tmp_path / "lyxpipe")
+    server = FakeLyXServer(base, lambda function, argument: "ERROR:{client}:{function}:Unknown buffer")
+    try:
+        with pytest.raises(DropLyx.LyXServerError, match="Unknown buffer"):
+            DropLyx.LyXServerClient(base, timeout=2).send("buffer-switch", "/nowhere.lyx")
+    finally:
+        server.close()
+
+
+@fifo_only
+def test_lyxserver_timeout(tmp_path):
+    base = str(tmp_path / "lyxpipe")
+    server = FakeLyXServer(base, lambda function, argument: None)
+    try:
+        with pytest.raises(DropLyx.LyXServerError, match="no reply"):
+            DropLyx.LyXServerClient(base, timeout=0.3).send("buffer-reload")
+    finally:
+        server.close()
+
+
+@fifo_only
+def test_lyxserver_not_running(tmp_path):
+    base = str(tmp_path / "lyxpipe")
+    os.mkfifo(f"{base}.in")
+    os.mkfifo(f"{base}.out")
+    with pytest.raises(DropLyx.LyXServerError, match="not running"):
+        DropLyx.LyXServerClient(base, timeout=0.3).send("server-get-filename")
@@ -0,0 +1,163 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import DropLyx  # noqa: E402
+
+
+def test_merge_line_words_disjoint_edits():
+    baseline = "We show the result holds. Then the proof ends here.\n"
+    local = "We show that the result holds. Then the proof ends here.\n"
+    remote = "We show the result holds. Then the short proof ends here.\n"
+    assert (DropLyx.merge_line_words(baseline, local, remote) ==
+            "We show that the result holds. Then the short proof ends here.\n")
+
+
+def test_merge_line_words_overlapping_edits():
+    baseline = "We show the result holds.\n"
+    assert DropLyx.merge_line_words(baseline, "We show a result holds.\n", "We show our result holds.\n") is None
+
+
+def test_merge_line_words_same_edit_applied_once():
+    baseline = "We show the result holds.\n"
+    changed = "We show a result holds.\n"
+    assert DropLyx.merge_line_words(baseline, changed, changed) == changed
+
+
+def test_merge_line_words_inserts_at_same_position_conflict():
+    baseline = "We show the result holds.\n"
+    assert DropLyx.merge_line_words(baseline, "We show the main result holds.\n",
+                                    "We show the new result holds.\n") is None
+
+
+def test_merge_line_words_cost_cap():
+    baseline = " ".join(f"w{i}" for i in range(100)) + "\n"
+    local = baseline.replace("w10 ", "x10 ")
+    remote = baseline.replace("w90 ", "x90 ")
+    assert DropLyx.merge_line_words(baseline, local, remote) is not None
+    assert DropLyx.merge_line_words(baseline, local, remote, max_cost=100) is None
+
+
+def test_merge_line_words_missing_line():
+    assert DropLyx.merge_line_words("a b\n", None, "a c\n") is None
+
+
+@pytest.fixture
+def paragraphs():
+    DropLyx.merge_cache.clear()
+    return ["Introduction comes first.\n", "We show the result holds.\n",
+            "Then the proof ends here.\n", "Conclusion follows.\n"]
+
+
+def test_merge_lines_word_merges_aligned_paragraph(paragraphs):
+    local = list(paragraphs)
+    local[1] = "We show that the result holds.\n"
+    remote = list(paragraphs)
+    remote[1] = "We show the result always holds.\n"
+    merged, conflicts = DropLyx.merge_lines(paragraphs, local, remote)
+    assert conflicts == []
+    assert merged[1] == "We show that the result always holds.\n"
+    assert merged[2:] == paragraphs[2:]
+
+
+def test_merge_lines_misaligned_paragraphs_conflict(paragraphs):
+    # Local deletes the paragraph remote edits: the remote edit must not land in the next paragraph
+    local = paragraphs[:1] + paragraphs[2:]
+    remote = list(paragraphs)
+    remote[1] = "We show a result holds.\n"
+    merged, conflicts = DropLyx.merge_lines(paragraphs, local, remote)
+    assert conflicts == [1]
+    assert "Then a proof ends here.\n" not in merged
+
+
+def test_merge_lines_separate_paragraphs(paragraphs):
+    local = list(paragraphs)
+    local[0] = "Introduction comes second.\n"
+    remote = list(paragraphs)
+    remote[3] = "Conclusion follows at last.\n"
+    merged, conflicts = DropLyx.merge_lines(paragraphs, local, remote)
+    assert conflicts == []
+    assert merged == [local[0], paragraphs[1], paragraphs[2], remote[3]]
+
+
+def numbered_lines(count):
+    return [f"line {i} of the document\n" for i in range(count)]
+
+
+def test_chunk_boundaries_resynchronise_after_insert():
+    lines = numbered_lines(400)
+    edited = lines[:100] + ["an inserted line\n"] + lines[100:]
+    old = DropLyx.chunk_fingerprints(lines)
+    new = DropLyx.chunk_fingerprints(edited)
+    assert sum(c[1] for c in new) == len(edited)
+    assert all(size <= DropLyx.CHUNK_MAX_LINES for _, size, _ in new)
+    # Only the chunks around the insertion differ, later ones are shifted by one line
+    assert len({c[1:] for c in old} ^ {c[1:] for c in new}) <= 4
+    assert old[-1][1:] == new[-1][1:] and new[-1][0] == old[-1][0] + 1
+
+
+def test_chunk_fingerprints_are_content_addressed():
+    lines = numbered_lines(100)
+    assert DropLyx.chunk_fingerprints(lines) == DropLyx.chunk_fingerprints(list(lines))
+    assert DropLyx.chunk_fingerprints([]) == []
+
+
+@pytest.mark.parametrize("baseline, local, remote", [
+    ([], [], []),
+    ([], ["a\n"], []),
+    (["a\n"], ["a\n", "a\n"], ["a\n"]),
+    (["a\n", "b\n"], ["a\n", "b\n"], ["a\n", "b\n"]),
+    (["x\n"] * 10, ["x\n"] * 9, ["x\n"] * 11),
+    (numbered_lines(300), numbered_lines(300)[:150] + numbered_lines(300)[151:], numbered_lines(300)),
+])
+def test_common_chunks_never_overlap(baseline, local, remote):
+    versions = [(lines, DropLyx.chunk_fingerprints(lines)) for lines in (baseline, local, remote)]
+    prefix, suffix = DropLyx.common_chunks(versions)
+    assert prefix + suffix <= min(len(baseline), len(local), len(remote))
+    for lines, _ in versions:
+        assert lines[:prefix] == baseline[:prefix]
+        assert lines[len(lines) - suffix:] == baseline[len(baseline) - suffix:]
+
+
+def test_common_chunks_trims_around_an_edit():
+    baseline = numbered_lines(300)
+    local = list(baseline)
+    local[150] = "changed\n"
+    versions = [(lines, DropLyx.chunk_fingerprints(lines)) for lines in (baseline, local, baseline)]
+    prefix, suffix = DropLyx.common_chunks(versions)
+    assert prefix <= 150 < len(baseline) - suffix
+    assert prefix + suffix >= len(baseline) - 2 * DropLyx.CHUNK_MAX_LINES
+
+
+def lyx_section(layout, title, paragraphs):
+    lines = [f"\\begin_layout {layout}\n", f"{title}\n", "\\end_layout\n"]
+    for text in paragraphs:
+        lines += ["\\begin_layout Standard\n", f"{text}\n", "\\end_layout\n"]
+    return lines
+
+
+def test_changed_section_names_the_edited_section():
+    baseline = (["#LyX 2.3 created this file.\n", "\\begin_body\n"] +
+                lyx_section("Section", "Introduction", [f"Intro paragraph {i}." for i in range(40)]) +
+                lyx_section("Section*", "Results", [f"Result paragraph {i}." for i in range(40)]) +
+                lyx_section("Subsection", "Proofs", [f"Proof paragraph {i}." for i in range(40)]))
+    chunks = DropLyx.chunk_fingerprints(baseline)
+    edited = list(baseline)
+    edited[edited.index("Result paragraph 30.\n")] = "Result paragraph 30, revised.\n"
+    assert DropLyx.changed_section(chunks, edited) == "Results"
+    edited = list(baseline)
+    edited[edited.index("Proof paragraph 25.\n")] = "Proof paragraph 25, revised.\n"
+    assert DropLyx.changed_section(chunks, edited) == "Proofs"
+    assert DropLyx.changed_section(chunks, ["#LyX\n", "no sections\n"]) is None
+
+
+def test_changed_section_edit_right_after_a_heading():
+    baseline = (lyx_section("Section", "Introduction", [f"Intro paragraph {i}." for i in range(40)]) +
+                lyx_section("Section", "Results", [f"Result paragraph {i}." for i in range(40)]))
+    chunks = DropLyx.chunk_fingerprints(baseline)
+    for text, section in [("Result paragraph 0.\n", "Results"), ("Intro paragraph 39.\n", "Introduction")]:
+        edited = list(baseline)
+        edited[edited.index(text)] = "revised\n"
+        assert DropLyx.changed_section(chunks, edited, baseline) == section